@@ -1,8 +1,10 @@
 import streamlit as st
-from PIL import Image
-import tempfile
 import numpy as np
+import json
 import os
+import shutil
+import tempfile
+import time
 
 # Check for required dependencies
 try:
@@ -11,11 +13,15 @@ except ImportError:
     st.error("❌ OpenCV is not installed. Please install it using: pip install opencv-python-headless")
     st.stop()
 
-try:
-    from ultralytics import YOLO
-except ImportError:
-    st.error("❌ Ultralytics is not installed. Please install it using: pip install ultralytics")
-    st.stop()
+from detection import (DetectionCache, RemoteBackend, ServiceBusy, build_export_zip, decode_bytes, decode_many,
+                       decode_reduced, detect, detection_rows, draw_detections, encode_jpeg, export_names, overlay_html,
+                       result_nbytes, tiled_predict)
+from streams import FrameGrabber, GrabberLease, analyze_video
+from tracking import MOTION_METHODS, KeyframeDetector, MotionGate
+from metrics import Metrics, RequestTimer, configure_json_logging, start_metrics_server
+from concurrency import AdmissionBackend, ResolutionController, available_cores, configure_threads
+from detection_log import DEFAULT_LOG_DIR, DetectionLogWriter, DetectionStore
+from registry import DEFAULT_MODEL_DIR, ModelRegistry
 
 # -------------- Page Config ----------------
 st.set_page_config(
@@ -362,29 +368,501 @@ st.markdown("""
 st.markdown('<hr class="divider">', unsafe_allow_html=True)
 
 
+# -------------- Detection Cache ----------------
+@st.cache_resource
+def get_detection_cache():
+    # Shared by all sessions: entries are keyed by image content, so they are safe to reuse
+    return DetectionCache(max_bytes=256 * 1024 * 1024)
+
+
+detection_cache = get_detection_cache()
+
+
+# -------------- Metrics ----------------
+@st.cache_resource
+def get_metrics():
+    metrics = Metrics()
+    cache = get_detection_cache()
+    metrics.set_gauge("cache_hits", lambda: cache.hits)
+    metrics.set_gauge("cache_misses", lambda: cache.misses)
+    metrics.set_gauge("cache_bytes", lambda: cache.nbytes)
+    # TRAFFIC_METRICS_PORT serves /metrics (Prometheus) and /metrics.json on localhost, or on
+    # TRAFFIC_METRICS_HOST (e.g. 0.0.0.0) when set; TRAFFIC_METRICS_LOG logs JSON lines
+    if os.environ.get("TRAFFIC_METRICS_PORT"):
+        start_metrics_server(metrics, int(os.environ["TRAFFIC_METRICS_PORT"]),
+                             os.environ.get("TRAFFIC_METRICS_HOST", "127.0.0.1"))
+    if os.environ.get("TRAFFIC_METRICS_LOG"):
+        configure_json_logging()
+    return metrics
+
+
+metrics = get_metrics()
+
+
+# -------------- Detection Log ----------------
+# Every displayed detection is appended to a columnar store on disk; TRAFFIC_DETECTION_LOG="" turns it off
+DETECTION_LOG_DIR = os.environ.get("TRAFFIC_DETECTION_LOG", DEFAULT_LOG_DIR)
+
+
+@st.cache_resource
+def get_detection_log():
+    if not DETECTION_LOG_DIR:
+        return None
+    return DetectionLogWriter(DetectionStore(DETECTION_LOG_DIR))
+
+
+detection_log = get_detection_log()
+
+
+def log_detections(source, dets, timestamp=None):
+    if detection_log is not None:
+        detection_log.write(source, dets, timestamp)
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def history_snapshot(classes, hours):
+    # Every tab body runs on every rerun; this keeps the scan to once a minute (or a Refresh click)
+    # across all sessions instead of once per interaction
+    store = detection_log.store
+    store.refresh()
+    return store.counts_per_hour(list(classes), start=time.time() - hours * 3600), store.stats()
+
+
 # -------------- Load YOLO Model ----------------
+# Set TRAFFIC_INFERENCE_URL (e.g. http://127.0.0.1:8765) to use a running server.py instead of an in-process model
+INFERENCE_URL = os.environ.get("TRAFFIC_INFERENCE_URL")
+# One of backends.BACKENDS: pytorch, pytorch-mmap, onnx, onnx-int8 or openvino
+INFERENCE_BACKEND = os.environ.get("TRAFFIC_BACKEND", "pytorch")
+# Versioned weights (v1.pt, v2.pt, ...); the newest is served and polled for every MODEL_POLL_SECONDS, 0 disables
+MODEL_DIR = os.environ.get("TRAFFIC_MODEL_DIR", DEFAULT_MODEL_DIR)
+MODEL_POLL_SECONDS = float(os.environ.get("TRAFFIC_MODEL_POLL", 5))
+# Default inference size; the model is warmed up at this size while loading
+DEFAULT_IMGSZ = int(os.environ.get("TRAFFIC_IMGSZ", 640))
+# Concurrent model calls across all sessions, and how many more may wait before getting "busy, retry"
+MAX_IN_FLIGHT = int(os.environ.get("TRAFFIC_MAX_INFLIGHT", 2))
+MAX_WAITING = int(os.environ.get("TRAFFIC_MAX_WAITING", 8))
+# Optional core pinning ("0-3,6") and thread caps; by default each in-flight call gets an equal share of the cores
+CPU_CORES = os.environ.get("TRAFFIC_CPU_CORES")
+TORCH_THREADS = os.environ.get("TRAFFIC_TORCH_THREADS")
+OPENCV_THREADS = int(os.environ.get("TRAFFIC_OPENCV_THREADS", 1))
+
+
+@st.cache_resource
+def apply_thread_budget():
+    # Process-wide, so it runs once before the model loads
+    applied = configure_threads(opencv_threads=OPENCV_THREADS, cores=CPU_CORES)
+    applied["inference_threads"] = int(TORCH_THREADS or max(1, available_cores() // MAX_IN_FLIGHT))
+    return applied
+
+
+thread_budget = apply_thread_budget()
+
+
+@st.cache_resource
+def load_registry(root, name):
+    try:
+        started = time.perf_counter()
+        registry = ModelRegistry(root, name, threads=thread_budget["inference_threads"], imgsz=DEFAULT_IMGSZ,
+                                 poll_interval=MODEL_POLL_SECONDS, metrics=metrics)
+        # A no-op unless the first version pulled in torch; caps its pool before any session calls it
+        thread_budget.update(configure_threads(torch_threads=thread_budget["inference_threads"]))
+        # The registry warms each version up while loading it, so the warm-up is reported from there
+        warmup_seconds = registry.active.warmup_seconds
+        metrics.set_gauge("startup_seconds", time.perf_counter() - started - warmup_seconds, phase="load")
+        metrics.set_gauge("startup_seconds", warmup_seconds, phase="warmup")
+        return registry
+    except FileNotFoundError:
+        st.error(f"❌ No model weights found. Put versioned .pt files in '{root}' or 'best.pt' in the project directory.")
+        return None
+    except ImportError as e:
+        st.error(f"❌ Missing dependency for the {name} backend: {str(e)}")
+        return None
+    except Exception as e:
+        st.error(f"❌ Error loading {name} model: {str(e)}")
+        return None
+
+
 @st.cache_resource
-def load_model():
+def load_remote_backend(url):
     try:
-        # Check if model file exists
-        if not os.path.exists("best.pt"):
-            st.error("❌ Model file 'best.pt' not found. Please ensure the model file is in the project directory.")
-            return None
-        return YOLO("best.pt")
+        return RemoteBackend(url)
     except Exception as e:
-        st.error(f"❌ Error loading model: {str(e)}")
+        st.error(f"❌ Could not reach inference service at {url}: {str(e)}")
         return None
 
 
-model = load_model()
+@st.cache_resource
+def admission_control(_backend, name):
+    # Shared by every session, so the in-flight limit holds process-wide
+    return AdmissionBackend(_backend, MAX_IN_FLIGHT, MAX_WAITING, metrics=metrics)
 
-if model is None:
-    st.warning("⚠️ Model not loaded. Please check if 'best.pt' file exists in your project directory.")
-    st.info("💡 You can download a pre-trained YOLOv8 model from Ultralytics or use your custom trained model.")
-    st.stop()
+
+@st.cache_resource
+def warm_up_backend(_backend, name, imgsz):
+    # Runs once per process so graph init and allocator warm-up never land on a user request
+    started = time.perf_counter()
+    _backend.warmup(imgsz)
+    metrics.set_gauge("startup_seconds", time.perf_counter() - started, phase="warmup")
+
+
+registry = None
+if INFERENCE_URL:
+    backend = load_remote_backend(INFERENCE_URL)
+    if backend is None:
+        st.stop()
+else:
+    # Newest file in MODEL_DIR (or best.pt); new files are loaded, warmed up and swapped in while serving
+    backend = registry = load_registry(MODEL_DIR, INFERENCE_BACKEND)
+
+    if registry is None:
+        st.warning("⚠️ Model not loaded. Please check if 'best.pt' file exists in your project directory.")
+        st.info("💡 You can download a pre-trained YOLOv8 model from Ultralytics or use your custom trained model.")
+        st.stop()
+
+if not INFERENCE_URL:
+    # server.py does its own queueing and answers 503 when full; in-process models are guarded here
+    backend = admission_control(backend, INFERENCE_BACKEND)
+
+if INFERENCE_URL:
+    # In-process models were already warmed up by the registry while loading
+    with st.spinner("🔥 Warming up the model..."):
+        warm_up_backend(backend, INFERENCE_URL, DEFAULT_IMGSZ)
+
+
+def render_timings(timer):
+    if not show_debug:
+        return
+    with st.expander("🛠️ Timing Debug Panel", expanded=True):
+        rows = [{"Stage": stage, "Time (ms)": round(ms, 2)} for stage, ms in timer.stages.items()]
+        rows.append({"Stage": "total", "Time (ms)": round(sum(timer.stages.values()), 2)})
+        st.dataframe(rows, use_container_width=True)
+        if timer.info:
+            st.caption(" | ".join(f"{k}: {v}" for k, v in timer.info.items()))
+
+
+def render_detections(dets, title, empty_message):
+    # One HTML block for the per-class counts and one table, instead of a message per box
+    if len(dets) == 0:
+        st.info(empty_message)
+        return
+    badges = "".join(
+        f'<span class="detection-item" style="display: inline-block; margin: 0.5rem; padding: 0.8rem 1.2rem;">'
+        f'🎯 {row["class"]}: <strong>{row["count"]}</strong> '
+        f'<span style="color: #28a745; font-weight: 600;">(max {row["max_conf"]:.0%})</span></span>'
+        for row in dets.class_summary()
+    )
+    st.markdown(f"""
+        <div class="detection-card">
+            <h3 style="color: white; margin-bottom: 1rem;">{title}</h3>
+            {badges}
+        </div>
+    """, unsafe_allow_html=True)
+    st.dataframe(
+        dets.columns(),
+        use_container_width=True,
+        hide_index=True,
+        column_config={"Confidence": st.column_config.NumberColumn(format="%.1f%%")}
+    )
+
+
+def run_inference(frames, batch_size=8):
+    # Upload paths: plain batched inference, or per-image tiling when enabled in the sidebar
+    params = {k: v for k, v in cached_params.items() if not k.startswith("tiled_")}
+    if not tiled:
+        return backend.predict(frames, batch_size=batch_size, **params)
+    return [tiled_predict(backend, frame, **tile_params, **params) for frame in frames]
+
+
+def render_tile_info(dets):
+    if dets.info.get("tiles"):
+        st.caption(
+            f"🧩 {dets.info['tiles']} tiles in {dets.info['tile_batches']} batches | "
+            f"{dets.info['ms_per_tile']} ms per tile | batch times: "
+            + ", ".join(f"{ms:.0f} ms" for ms in dets.info["batch_ms"])
+        )
+
+
+def annotated_jpeg(cache_key, min_conf, dets, load_frame, timer, full_resolution=False):
+    # Annotated images are cached per display threshold and resolution; the detections underneath are shared
+    key = f"{cache_key}:annotated:{min_conf}:{'full' if full_resolution else 'preview'}"
+    jpeg = detection_cache.get(key)
+    if jpeg is None:
+        frame = load_frame()
+        with timer.stage("annotate"):
+            # Boxes are stored in original-image pixels and mapped onto whatever frame was loaded
+            annotated_frame = draw_detections(frame, dets.rescaled(frame.shape[:2]))
+        with timer.stage("encode"):
+            jpeg = encode_jpeg(annotated_frame)
+        detection_cache.put(key, jpeg, len(jpeg))
+    return jpeg
+
+
+# Long side of the image embedded under the overlay; the SVG boxes scale to it from original-image pixels
+OVERLAY_DISPLAY_SIZE = 1280
+
+
+def display_jpeg(cache_key, load_frame, timer):
+    # The overlay inlines its image as base64 and is re-sent on every rerun, so it gets a display-sized
+    # JPEG made once per upload from the (upright) decoded frame rather than the raw multi-MB upload
+    key = f"{cache_key}:display"
+    jpeg = detection_cache.get(key)
+    if jpeg is None:
+        frame = load_frame()
+        scale = OVERLAY_DISPLAY_SIZE / max(frame.shape[:2])
+        with timer.stage("encode"):
+            if scale < 1:
+                frame = cv2.resize(frame, (round(frame.shape[1] * scale), round(frame.shape[0] * scale)),
+                                   interpolation=cv2.INTER_AREA)
+            jpeg = encode_jpeg(frame, quality=85)
+        detection_cache.put(key, jpeg, len(jpeg))
+    return jpeg
+
+
+def render_overlay(image, dets, caption, mime="image/jpeg"):
+    st.markdown(overlay_html(image, dets, mime), unsafe_allow_html=True)
+    st.caption(caption)
+
+
+def render_webcam_capture(capture):
+    st.markdown(
+        '<div style="background: linear-gradient(145deg, rgba(0,0,0,0.8), rgba(30,30,50,0.9)); padding: 1.5rem; border-radius: 20px; backdrop-filter: blur(10px); border: 2px solid rgba(102, 126, 234, 0.3);"><h3 style="color: white; font-size: 1.8rem; text-shadow: 2px 2px 4px rgba(0,0,0,0.7); margin-bottom: 1rem;">🎯 Live Analysis</h3></div>',
+        unsafe_allow_html=True)
+    render_overlay(capture["jpeg"], capture["dets"], "AI Detection")
+
+
+def detections_json(dets):
+    return json.dumps({**dets.to_dict(), "names": {str(k): v for k, v in dets.names.items()}})
+
+
+def overlay_downloads(ready_key, dets, make_annotated, file_stem, button_key):
+    # Overlay mode: the detections download as JSON right away; the annotated JPEG is only drawn
+    # and encoded once the user asks for it (the choice sticks across reruns for this result)
+    col1, col2 = st.columns(2)
+    with col1:
+        st.download_button(
+            "📄 Download Detections (JSON)",
+            detections_json(dets),
+            f"{file_stem}.json",
+            "application/json",
+            use_container_width=True
+        )
+    with col2:
+        annotated_download(ready_key, make_annotated, file_stem, button_key)
+
+
+def annotated_download(ready_key, make_annotated, file_stem, button_key):
+    # Full-resolution annotated JPEGs cost a full decode, so they are only drawn and encoded on request
+    if st.session_state.get(button_key) == ready_key or st.button(
+            "🖼️ Prepare Annotated Image", key=f"{button_key}_button", use_container_width=True):
+        st.session_state[button_key] = ready_key
+        st.download_button(
+            "📥 Download Analysis Results",
+            make_annotated(),
+            f"{file_stem}.jpg",
+            "image/jpeg",
+            use_container_width=True
+        )
+
+
+@st.cache_resource
+def get_resolution_controller(target_ms, max_imgsz):
+    # Process-wide: load comes from every session, so they all share one view of recent latency
+    return ResolutionController(target_ms, max_imgsz)
+
+
+def finish_request(timer, ran_model=True, **info):
+    # Records the request and feeds its latency to the SLO controller; cache hits and skipped frames
+    # say nothing about model load, so they are not observed
+    imgsz = infer_params["imgsz"]
+    total_ms = timer.finish(imgsz=imgsz, **info)
+    if resolution_controller is not None and ran_model:
+        resolution_controller.observe(total_ms)
+    return imgsz, total_ms
+
+
+def render_resolution(imgsz, total_ms):
+    if resolution_controller is not None:
+        st.caption(f"📐 Inference size {imgsz} px (adaptive, target {resolution_controller.target_ms} ms) | "
+                   f"latency {total_ms:.0f} ms")
+
+
+def motion_gated(name, frame, timer, run):
+    # Camera paths: reuse the previous (dets, annotated) while the scene is static, else call run()
+    if not motion_gating:
+        return run(), False
+    gate = st.session_state.get(name)
+    if gate is None or gate.method != motion_method:
+        gate = st.session_state[name] = MotionGate(motion_threshold, motion_method)
+    gate.threshold = motion_threshold
+    # The cached image is annotated or plain depending on the display mode, so the mode is part of the key
+    result, skipped = gate.gated(frame, run, key=(tuple(sorted(infer_params.items())), overlay_results))
+    timer.info["motion_skipped"] = skipped
+    metrics.inc("motion_gate_total", source=timer.source, outcome="skip" if skipped else "run")
+    return result, skipped
+
+
+def render_motion_stats(name):
+    gate = st.session_state.get(name)
+    if motion_gating and gate is not None:
+        stats = gate.stats()
+        score = "n/a" if gate.last_score is None else f"{gate.last_score:.3f}"
+        st.caption(
+            f"🎞️ Motion gate: change score {score} (threshold {gate.threshold:.3f}) | "
+            f"model calls {stats['model_calls']} / {stats['checks']} frames | skipped {stats['skip_rate']:.0%}"
+        )
+
+
+# Widget callbacks run before the script, so a choice made here is in effect for the rerun it triggers
+def on_version_selected():
+    # A manual choice (e.g. a rollback) pins that version until "serve newest" is turned back on
+    registry.activate(st.session_state["serving_version"])
+
+
+def on_follow_newest():
+    registry.follow(st.session_state["follow_newest"])
+
+
+def on_candidate_changed():
+    candidate = st.session_state["ab_candidate"]
+    registry.set_candidate(None if candidate == NO_CANDIDATE else candidate, st.session_state["ab_split"])
+
+
+# -------------- Detection Settings ----------------
+MIN_CONF = 0.05
+NO_CANDIDATE = "—"
+
+with st.sidebar:
+    st.markdown("### ⚙️ Detection Settings")
+    infer_params = {
+        "conf": st.slider("Confidence threshold", min_value=MIN_CONF, max_value=0.95, value=0.25, step=0.05),
+        "iou": st.slider("NMS IoU threshold", min_value=0.1, max_value=0.95, value=0.7, step=0.05),
+        "imgsz": st.select_slider("Inference size", options=[320, 416, 512, 640, 800, 960, 1280],
+                                  value=DEFAULT_IMGSZ),
+    }
+
+    st.markdown("### ⏱️ Latency Target")
+    adaptive_imgsz = st.checkbox(
+        "Adapt inference size to load",
+        value=False,
+        help="Step the inference size down (e.g. 640 → 512 → 416 → 320) when recent latency exceeds the target, "
+             "and back up when there is headroom"
+    )
+    latency_target = st.slider("Target latency (ms)", min_value=50, max_value=3000, value=500, step=50,
+                               disabled=not adaptive_imgsz)
+    resolution_controller = None
+    if adaptive_imgsz:
+        # The selected inference size is the ceiling; the controller only ever goes below it
+        resolution_controller = get_resolution_controller(latency_target, infer_params["imgsz"])
+        infer_params["imgsz"] = resolution_controller.imgsz
+        slo = resolution_controller.stats()
+        st.caption(
+            f"Current size: {slo['imgsz']} px | recent p90: "
+            + (f"{slo['p90_ms']:.0f} ms" if slo["p90_ms"] is not None else "n/a")
+            + f" | steps down {slo['steps_down']} / up {slo['steps_up']}"
+        )
+
+    overlay_results = st.checkbox(
+        "Draw boxes in the browser",
+        value=True,
+        help="Overlay the detections on the original image instead of sending a second, annotated JPEG; "
+             "the annotated image is only rendered when you download it"
+    )
+
+    # Uploads run once at the lowest threshold and are filtered client-side, so moving the
+    # confidence slider never re-runs the model (NMS keeps every box above any higher threshold)
+    cached_params = {**infer_params, "conf": MIN_CONF}
+
+    st.markdown("### 🧩 Tiled Inference")
+    tiled = st.checkbox(
+        "Tile large images",
+        value=False,
+        help="Split high-resolution uploads into overlapping tiles so small, distant lights are not lost"
+    )
+    tile_params = {}
+    if tiled:
+        tile_params = {
+            "tile_size": st.select_slider("Tile size", options=[320, 480, 640, 800, 960], value=640),
+            "overlap": st.slider("Tile overlap", min_value=0.0, max_value=0.5, value=0.2, step=0.05),
+            "tile_batch": st.slider("Tiles per batch", min_value=1, max_value=16, value=8),
+        }
+        # Tiled results must not be served from the untiled cache entry and vice versa
+        cached_params = {**cached_params, **{f"tiled_{k}": v for k, v in tile_params.items()}}
+
+    st.markdown("### 🎞️ Motion Gating")
+    motion_gating = st.checkbox(
+        "Skip unchanged camera frames",
+        value=False,
+        help="Reuse the previous detections while a fixed camera's scene has not changed since the last analyzed frame"
+    )
+    motion_method = st.selectbox(
+        "Change detector", MOTION_METHODS,
+        format_func=lambda m: {"diff": "Frame difference", "hash": "Perceptual hash"}[m],
+        disabled=not motion_gating
+    )
+    motion_threshold = st.slider(
+        "Change threshold", min_value=0.0, max_value=0.2, value=0.02, step=0.005, format="%.3f",
+        disabled=not motion_gating,
+        help="Share of change (0-1) below which the scene counts as static"
+    )
+    if registry is not None:
+        st.markdown("### 🗂️ Model Registry")
+        versions = list(reversed(registry.scan()))
+        active_version = registry.active.version
+        if active_version not in versions:
+            versions.append(active_version)
+        # Shared by every session: reflect hot reloads and changes made elsewhere before drawing the widgets
+        st.session_state["serving_version"] = active_version
+        st.session_state["follow_newest"] = not registry.pinned
+        st.session_state["ab_candidate"] = registry.candidate.version if registry.candidate else NO_CANDIDATE
+        if registry.candidate is not None:
+            st.session_state["ab_split"] = registry.split
+        else:
+            st.session_state.setdefault("ab_split", 0.1)
+        st.selectbox("Serving version", versions, key="serving_version", on_change=on_version_selected,
+                     help=f"Weight files in {MODEL_DIR}, newest first")
+        st.checkbox("Serve newest version automatically", key="follow_newest", on_change=on_follow_newest,
+                    help="New files are loaded and warmed up in the background, then swapped in without "
+                         "interrupting running requests")
+        st.selectbox("A/B candidate", [NO_CANDIDATE] + [v for v in versions if v != active_version],
+                     key="ab_candidate", on_change=on_candidate_changed)
+        st.slider("Candidate traffic share", min_value=0.05, max_value=0.95, step=0.05,
+                  key="ab_split", on_change=on_candidate_changed, disabled=registry.candidate is None)
+        st.dataframe(registry.stats(), use_container_width=True, hide_index=True)
+        if registry.error:
+            st.caption(f"⚠️ Last reload failed: {registry.error}")
+
+    # Uploads are decoded near the model input size, except when tiling needs every pixel
+    decode_target = None if tiled else infer_params["imgsz"]
+    cache_stats = detection_cache.stats()
+    st.caption(
+        f"Result cache: {cache_stats['entries']} entries, {cache_stats['bytes'] / 1e6:.1f} MB | "
+        f"hits {cache_stats['hits']} / misses {cache_stats['misses']} ({cache_stats['hit_rate']:.0%})"
+    )
+    startup = metrics.gauges("startup_seconds")
+    first_request = metrics.gauges("first_request_seconds")
+    if startup:
+        st.caption("Startup: " + " | ".join(f"{k} {v:.2f}s" for k, v in startup.items()))
+    if first_request:
+        st.caption("First request: " + " | ".join(f"{k} {v * 1000:.0f} ms" for k, v in first_request.items()))
+    if isinstance(backend, AdmissionBackend):
+        admission = backend.stats()
+        st.caption(
+            f"Model slots: {admission['in_flight']}/{admission['max_in_flight']} busy, "
+            f"{admission['waiting']} waiting | rejected {admission['rejected']} | "
+            f"{thread_budget['inference_threads']} threads per call"
+        )
+    show_debug = st.checkbox("🛠️ Show timing debug panel", value=False)
+    st.download_button(
+        "📈 Export Metrics (Prometheus)",
+        metrics.render_prometheus(),
+        "traffic_ai_metrics.txt",
+        "text/plain",
+        use_container_width=True
+    )
 
 # -------------- Enhanced Tabs ----------------
-tab1, tab2 = st.tabs(["📂 Upload & Analyze", "📸 Live Camera Detection"])
+tab1, tab2, tab3, tab4 = st.tabs(["📂 Upload & Analyze", "📸 Live Camera Detection", "🎬 Video Analysis",
+                                  "📊 Detection History"])
 
 # -------------- Enhanced Upload Tab ----------------
 with tab1:
@@ -395,79 +873,210 @@ with tab1:
         </div>
     """, unsafe_allow_html=True)
 
-    uploaded_file = st.file_uploader(
-        "Choose an image file",
+    uploaded_files = st.file_uploader(
+        "Choose image files",
         type=["jpg", "jpeg", "png"],
-        help="Upload an image to detect traffic elements"
+        accept_multiple_files=True,
+        help="Upload one image for a detailed view, or several for batch analysis"
     )
+    uploaded_file = uploaded_files[0] if len(uploaded_files) == 1 else None
 
     if uploaded_file:
-        col1, col2 = st.columns(2)
-
-        with col1:
-            img = Image.open(uploaded_file)
-            st.markdown(
-                '<div style="background: linear-gradient(145deg, rgba(0,0,0,0.8), rgba(30,30,50,0.9)); padding: 1.5rem; border-radius: 20px; backdrop-filter: blur(10px); border: 2px solid rgba(102, 126, 234, 0.3);"><h3 style="color: white; font-size: 1.8rem; text-shadow: 2px 2px 4px rgba(0,0,0,0.7); margin-bottom: 1rem;">🖼️ Original Image</h3></div>',
-                unsafe_allow_html=True)
-            st.image(img, caption="Input Image", use_column_width=True)
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as temp_file:
-            img.save(temp_file.name)
-            image_path = temp_file.name
+        timer = RequestTimer(metrics, "upload")
+        if not overlay_results:
+            col1, col2 = st.columns(2)
+
+            with col1:
+                st.markdown(
+                    '<div style="background: linear-gradient(145deg, rgba(0,0,0,0.8), rgba(30,30,50,0.9)); padding: 1.5rem; border-radius: 20px; backdrop-filter: blur(10px); border: 2px solid rgba(102, 126, 234, 0.3);"><h3 style="color: white; font-size: 1.8rem; text-shadow: 2px 2px 4px rgba(0,0,0,0.7); margin-bottom: 1rem;">🖼️ Original Image</h3></div>',
+                    unsafe_allow_html=True)
+                with timer.stage("render"):
+                    # The uploaded bytes go to the browser as-is; the server never decodes them for display
+                    st.image(uploaded_file.getvalue(), caption="Input Image", use_column_width=True)
 
         with st.spinner("🔍 AI is analyzing your image..."):
             try:
-                results = model(image_path)
-                results[0].save(filename="output.jpg")
-
-                with col2:
+                # Reruns (e.g. the download click) hit the cache instead of the model
+                with timer.stage("cache_lookup"):
+                    cache_key = DetectionCache.make_key(uploaded_file.getvalue(), backend.weights_hash, **cached_params)
+                    all_dets = detection_cache.get(cache_key)
+                cache_hit = all_dets is not None
+                frame_holder = []
+
+                def load_frame():
+                    if not frame_holder:
+                        with timer.stage("decode"):
+                            frame_holder.extend(decode_reduced(uploaded_file.getvalue(), decode_target))
+                    return frame_holder[0]
+
+                def load_full_frame():
+                    # Downloads are drawn on the full-resolution image; the reduced decode only feeds the
+                    # model and the on-screen preview
+                    if decode_target is None:
+                        return load_frame()
+                    with timer.stage("decode"):
+                        return decode_bytes(uploaded_file.getvalue())
+
+                if all_dets is None:
+                    frame = load_frame()
+                    with timer.stage("infer"):
+                        # Boxes come back in decoded-frame pixels; store them in original-image pixels
+                        all_dets = run_inference([frame])[0].rescaled(frame_holder[1])
+                    detection_cache.put(cache_key, all_dets, result_nbytes(all_dets))
+                    log_detections("upload", all_dets.filter(infer_params["conf"]))
+                with timer.stage("postprocess"):
+                    dets = all_dets.filter(infer_params["conf"])
+
+                if overlay_results:
                     st.markdown(
                         '<div style="background: linear-gradient(145deg, rgba(0,0,0,0.8), rgba(30,30,50,0.9)); padding: 1.5rem; border-radius: 20px; backdrop-filter: blur(10px); border: 2px solid rgba(102, 126, 234, 0.3);"><h3 style="color: white; font-size: 1.8rem; text-shadow: 2px 2px 4px rgba(0,0,0,0.7); margin-bottom: 1rem;">🎯 Detection Results</h3></div>',
                         unsafe_allow_html=True)
-                    st.image("output.jpg", caption="AI Analysis", use_column_width=True)
-
+                    with timer.stage("render"):
+                        # A display-sized copy goes to the browser, with the boxes drawn over it client-side
+                        render_overlay(display_jpeg(cache_key, load_frame, timer), dets, "AI Analysis")
+                    render_tile_info(dets)
+                else:
+                    annotated = annotated_jpeg(cache_key, infer_params["conf"], dets, load_frame, timer)
+                    with col2:
+                        st.markdown(
+                            '<div style="background: linear-gradient(145deg, rgba(0,0,0,0.8), rgba(30,30,50,0.9)); padding: 1.5rem; border-radius: 20px; backdrop-filter: blur(10px); border: 2px solid rgba(102, 126, 234, 0.3);"><h3 style="color: white; font-size: 1.8rem; text-shadow: 2px 2px 4px rgba(0,0,0,0.7); margin-bottom: 1rem;">🎯 Detection Results</h3></div>',
+                            unsafe_allow_html=True)
+                        with timer.stage("render"):
+                            st.image(annotated, caption="AI Analysis", use_column_width=True)
+                        render_tile_info(dets)
                 st.success("✅ Detection completed successfully!")
 
                 # Enhanced results display
-                if results[0].boxes is not None and len(results[0].boxes) > 0:
-                    st.markdown("""
-                        <div class="detection-card">
-                            <h3 style="color: white; margin-bottom: 1rem;">📊 Detected Objects</h3>
-                        </div>
-                    """, unsafe_allow_html=True)
-
-                    for i, box in enumerate(results[0].boxes):
-                        cls = model.names[int(box.cls)]
-                        conf = float(box.conf)
-                        st.markdown(f"""
-                            <div class="detection-item">
-                                <strong>🎯 {cls}</strong> — Confidence: <span style="color: #28a745; font-weight: 600;">{conf:.2%}</span>
-                            </div>
-                        """, unsafe_allow_html=True)
-                else:
-                    st.info("ℹ️ No objects detected in this image.")
+                with timer.stage("render"):
+                    render_detections(dets, "📊 Detected Objects", "ℹ️ No objects detected in this image.")
+                render_resolution(*finish_request(timer, not cache_hit, cache_hit=cache_hit, detections=len(dets)))
+                render_timings(timer)
 
                 # Enhanced download section
+                if overlay_results:
+                    overlay_downloads(
+                        f"{cache_key}:{infer_params['conf']}", dets,
+                        lambda: annotated_jpeg(cache_key, infer_params["conf"], dets, load_full_frame, timer, True),
+                        "traffic_analysis", "upload_annotated"
+                    )
+                else:
+                    col1, col2, col3 = st.columns([1, 2, 1])
+                    with col2:
+                        if decode_target is None:
+                            # Tiled mode decoded the full image already, so the preview is the download
+                            st.download_button(
+                                "📥 Download Analysis Results",
+                                annotated,
+                                "traffic_analysis.jpg",
+                                "image/jpeg",
+                                use_container_width=True
+                            )
+                        else:
+                            annotated_download(
+                                f"{cache_key}:{infer_params['conf']}",
+                                lambda: annotated_jpeg(cache_key, infer_params["conf"], dets, load_full_frame, timer,
+                                                       True),
+                                "traffic_analysis", "upload_annotated"
+                            )
+
+            except ServiceBusy as e:
+                st.warning(f"⏳ {str(e)}")
+            except Exception as e:
+                st.error(f"❌ Error during detection: {str(e)}")
+
+    # -------------- Batch Analysis ----------------
+    elif uploaded_files:
+        batch_size = st.slider("Inference batch size", min_value=1, max_value=32, value=8)
+
+        with st.spinner(f"🔍 AI is analyzing {len(uploaded_files)} images..."):
+            try:
+                timer = RequestTimer(metrics, "batch")
+                started = time.perf_counter()
+                blobs = [f.getvalue() for f in uploaded_files]
+                with timer.stage("cache_lookup"):
+                    keys = [DetectionCache.make_key(data, backend.weights_hash, **cached_params) for data in blobs]
+                    cached = [detection_cache.get(key) for key in keys]
+                pending = [i for i, entry in enumerate(cached) if entry is None]
+                # One batch of decoded frames is alive at a time, so peak memory follows the batch size,
+                # not the number of uploads; only the encoded bytes are kept for the export
+                for start in range(0, len(pending), batch_size):
+                    chunk = pending[start:start + batch_size]
+                    with timer.stage("decode"):
+                        decoded = decode_many([blobs[i] for i in chunk], decode_target)
+                    with timer.stage("infer"):
+                        detections = run_inference([frame for frame, _ in decoded], batch_size)
+                    for i, (_, orig_shape), dets in zip(chunk, decoded, detections):
+                        all_dets = dets.rescaled(orig_shape)
+                        detection_cache.put(keys[i], all_dets, result_nbytes(all_dets))
+                        cached[i] = all_dets
+                        log_detections("upload", all_dets.filter(infer_params["conf"]))
+                    del decoded, detections
+
+                summary, rows, filtered = [], [], []
+                names = export_names([f.name for f in uploaded_files])
+                for i, (name, all_dets) in enumerate(zip(names, cached)):
+                    with timer.stage("postprocess"):
+                        dets = all_dets.filter(infer_params["conf"])
+                    filtered.append(dets)
+                    image_rows = detection_rows(dets, name)
+                    rows.extend(image_rows)
+                    summary.append({
+                        "Image": name,
+                        "Size": f"{dets.orig_shape[1]}x{dets.orig_shape[0]}",
+                        "Detections": len(dets),
+                        "Classes": ", ".join(f"{c['class']} ×{c['count']}" for c in dets.class_summary()),
+                        "Inference (ms)": round(sum(dets.speed.values()), 1),
+                        "Tiles": dets.info.get("tiles", 1),
+                    })
+                elapsed = time.perf_counter() - started
+
+                st.success(
+                    f"✅ Analyzed {len(blobs)} images in {elapsed:.1f}s "
+                    f"({len(blobs) / elapsed:.1f} images/sec, {len(blobs) - len(pending)} from cache)"
+                )
+                st.markdown("""
+                    <div class="detection-card">
+                        <h3 style="color: white; margin-bottom: 1rem;">📊 Batch Summary</h3>
+                    </div>
+                """, unsafe_allow_html=True)
+                with timer.stage("render"):
+                    st.dataframe(summary, use_container_width=True)
+
+                def export_zip():
+                    annotated = {
+                        name: annotated_jpeg(
+                            keys[i], infer_params["conf"], filtered[i],
+                            lambda i=i: decode_bytes(blobs[i]), timer, True)
+                        for i, name in enumerate(names)
+                    }
+                    with timer.stage("zip_export"):
+                        return build_export_zip(annotated, rows)
+
+                # In overlay mode the annotated images are only drawn and zipped when the download is requested
+                batch_key = f"{':'.join(keys)}:{infer_params['conf']}"
+                show_export = not overlay_results or st.session_state.get("batch_export") == batch_key
                 col1, col2, col3 = st.columns([1, 2, 1])
                 with col2:
-                    with open("output.jpg", "rb") as f:
+                    if not show_export and st.button("🗜️ Prepare ZIP Export", use_container_width=True):
+                        st.session_state["batch_export"] = batch_key
+                        show_export = True
+                    if show_export:
                         st.download_button(
-                            "📥 Download Analysis Results",
-                            f,
-                            "traffic_analysis.jpg",
-                            "image/jpeg",
+                            "📦 Download All Results (ZIP)",
+                            export_zip(),
+                            "traffic_analysis_batch.zip",
+                            "application/zip",
                             use_container_width=True
                         )
+                finish_request(timer, False, images=len(blobs), cache_hits=len(blobs) - len(pending),
+                               batch_size=batch_size)
+                render_timings(timer)
 
+            except ServiceBusy as e:
+                st.warning(f"⏳ {str(e)}")
             except Exception as e:
                 st.error(f"❌ Error during detection: {str(e)}")
 
-        # Clean up temporary file
-        try:
-            os.unlink(image_path)
-        except:
-            pass
-
 # -------------- Enhanced Webcam Tab ----------------
 with tab2:
     st.markdown("""
@@ -484,66 +1093,70 @@ with tab2:
     if cap_btn:
         with st.spinner("📸 Accessing camera and capturing image..."):
             try:
-                cap = cv2.VideoCapture(0)
+                timer = RequestTimer(metrics, "webcam")
+                with timer.stage("capture"):
+                    cap = cv2.VideoCapture(0)
                 if not cap.isOpened():
                     st.error(
                         "❌ Could not access webcam. Please check your camera permissions and ensure no other application is using the camera.")
                 else:
-                    ret, frame = cap.read()
-                    cap.release()
+                    with timer.stage("capture"):
+                        ret, frame = cap.read()
+                        cap.release()
 
                     if ret:
-                        frame = cv2.resize(frame, (640, 480))
-                        img_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                        img_pil = Image.fromarray(img_rgb)
-                        img_pil.save("webcam.jpg")
-
-                        col1, col2 = st.columns(2)
-
-                        with col1:
-                            st.markdown(
-                                '<div style="background: linear-gradient(145deg, rgba(0,0,0,0.8), rgba(30,30,50,0.9)); padding: 1.5rem; border-radius: 20px; backdrop-filter: blur(10px); border: 2px solid rgba(102, 126, 234, 0.3);"><h3 style="color: white; font-size: 1.8rem; text-shadow: 2px 2px 4px rgba(0,0,0,0.7); margin-bottom: 1rem;">📸 Captured Image</h3></div>',
-                                unsafe_allow_html=True)
-                            st.image(img_pil, caption="Live Capture", use_column_width=True)
-
-                        with st.spinner("🔍 Analyzing captured image..."):
-                            results = model("webcam.jpg")
-                            results[0].save(filename="webcam_output.jpg")
+                        with timer.stage("resize"):
+                            frame = cv2.resize(frame, (640, 480))
+
+                        if overlay_results:
+                            with st.spinner("🔍 Analyzing captured image..."):
+                                (dets, annotated), skipped = motion_gated(
+                                    "webcam_gate", frame, timer,
+                                    lambda: detect(backend, frame, timer, annotate=False, **infer_params))
+                            # Kept so reruns (e.g. preparing the download) can redraw this capture without the camera
+                            st.session_state["webcam_capture"] = {
+                                "frame": frame, "jpeg": annotated, "dets": dets, "id": time.time()}
+                            with timer.stage("render"):
+                                render_webcam_capture(st.session_state["webcam_capture"])
+                        else:
+                            col1, col2 = st.columns(2)
 
-                            with col2:
+                            with col1:
                                 st.markdown(
-                                    '<div style="background: linear-gradient(145deg, rgba(0,0,0,0.8), rgba(30,30,50,0.9)); padding: 1.5rem; border-radius: 20px; backdrop-filter: blur(10px); border: 2px solid rgba(102, 126, 234, 0.3);"><h3 style="color: white; font-size: 1.8rem; text-shadow: 2px 2px 4px rgba(0,0,0,0.7); margin-bottom: 1rem;">🎯 Live Analysis</h3></div>',
+                                    '<div style="background: linear-gradient(145deg, rgba(0,0,0,0.8), rgba(30,30,50,0.9)); padding: 1.5rem; border-radius: 20px; backdrop-filter: blur(10px); border: 2px solid rgba(102, 126, 234, 0.3);"><h3 style="color: white; font-size: 1.8rem; text-shadow: 2px 2px 4px rgba(0,0,0,0.7); margin-bottom: 1rem;">📸 Captured Image</h3></div>',
                                     unsafe_allow_html=True)
-                                st.image("webcam_output.jpg", caption="AI Detection", use_column_width=True)
+                                with timer.stage("render"):
+                                    st.image(frame, caption="Live Capture", channels="BGR", use_column_width=True)
+
+                            with st.spinner("🔍 Analyzing captured image..."):
+                                (dets, annotated), skipped = motion_gated(
+                                    "webcam_gate", frame, timer, lambda: detect(backend, frame, timer, **infer_params))
+
+                                with col2:
+                                    st.markdown(
+                                        '<div style="background: linear-gradient(145deg, rgba(0,0,0,0.8), rgba(30,30,50,0.9)); padding: 1.5rem; border-radius: 20px; backdrop-filter: blur(10px); border: 2px solid rgba(102, 126, 234, 0.3);"><h3 style="color: white; font-size: 1.8rem; text-shadow: 2px 2px 4px rgba(0,0,0,0.7); margin-bottom: 1rem;">🎯 Live Analysis</h3></div>',
+                                        unsafe_allow_html=True)
+                                    with timer.stage("render"):
+                                        st.image(annotated, caption="AI Detection", use_column_width=True)
 
                         st.success("✅ Live detection completed!")
 
                         # Results display
-                        if results[0].boxes is not None and len(results[0].boxes) > 0:
-                            st.markdown("""
-                                <div class="detection-card">
-                                    <h3 style="color: white; margin-bottom: 1rem;">📊 Live Detection Results</h3>
-                                </div>
-                            """, unsafe_allow_html=True)
-
-                            for box in results[0].boxes:
-                                cls = model.names[int(box.cls)]
-                                conf = float(box.conf)
-                                st.markdown(f"""
-                                    <div class="detection-item">
-                                        <strong>🎯 {cls}</strong> — Confidence: <span style="color: #28a745; font-weight: 600;">{conf:.2%}</span>
-                                    </div>
-                                """, unsafe_allow_html=True)
-                        else:
-                            st.info("ℹ️ No objects detected in the captured image.")
+                        with timer.stage("render"):
+                            render_detections(dets, "📊 Live Detection Results",
+                                              "ℹ️ No objects detected in the captured image.")
+                        log_detections("webcam", dets)
+                        render_resolution(*finish_request(timer, not skipped, detections=len(dets)))
+                        render_motion_stats("webcam_gate")
+                        render_timings(timer)
 
                         # Download option
-                        col1, col2, col3 = st.columns([1, 2, 1])
-                        with col2:
-                            with open("webcam_output.jpg", "rb") as f:
+                        if not overlay_results:
+                            col1, col2, col3 = st.columns([1, 2, 1])
+                            with col2:
                                 st.download_button(
                                     "📥 Download Live Analysis",
-                                    f,
+                                    annotated,
                                     "live_traffic_analysis.jpg",
                                     "image/jpeg",
                                     use_container_width=True
@@ -551,9 +1164,217 @@ with tab2:
                     else:
                         st.error("❌ Could not capture image from webcam.")
 
+            except ServiceBusy as e:
+                st.warning(f"⏳ {str(e)}")
             except Exception as e:
                 st.error(f"❌ Camera error: {str(e)}")
 
+    elif overlay_results and "webcam_capture" in st.session_state:
+        render_webcam_capture(st.session_state["webcam_capture"])
+        render_detections(st.session_state["webcam_capture"]["dets"], "📊 Live Detection Results",
+                          "ℹ️ No objects detected in the captured image.")
+
+    if overlay_results and "webcam_capture" in st.session_state:
+        capture = st.session_state["webcam_capture"]
+        overlay_downloads(
+            capture["id"], capture["dets"], lambda: encode_jpeg(draw_detections(capture["frame"], capture["dets"])),
+            "live_traffic_analysis", "webcam_annotated"
+        )
+
+    # -------------- Live Stream ----------------
+    st.markdown('<hr class="divider">', unsafe_allow_html=True)
+    st.markdown("""
+        <div class="webcam-section">
+            <h3 style="color: white; margin-bottom: 1rem;">📡 Continuous Live Stream</h3>
+            <p style="color: rgba(255,255,255,0.9); margin-bottom: 2rem;">Keep the camera open and analyze the latest frame continuously</p>
+        </div>
+    """, unsafe_allow_html=True)
+
+    col1, col2 = st.columns(2)
+    with col1:
+        stream_source = st.text_input(
+            "Video source",
+            value="0",
+            help="Camera index (0), path to a video file, RTSP URL, or 'synthetic' for a generated test feed"
+        )
+    with col2:
+        target_fps = st.slider("Target FPS", min_value=1, max_value=30, value=5)
+
+    col1, col2 = st.columns(2)
+    with col1:
+        stream_keyframes = st.slider(
+            "Run model every Nth frame", min_value=1, max_value=30, value=1,
+            help="Frames in between are tracked with optical flow, which is much cheaper than detection"
+        )
+    with col2:
+        adaptive_keyframes = st.checkbox(
+            "Adaptive interval", value=False, disabled=stream_keyframes == 1,
+            help="Run the model more often when tracks appear, vanish or change state, less often when the scene is static"
+        )
+
+    col1, col2 = st.columns(2)
+    with col1:
+        start_btn = st.button("▶️ Start Stream", use_container_width=True)
+    with col2:
+        stop_btn = st.button("⏹️ Stop Stream", use_container_width=True)
+
+    # No local reference to the lease itself: the session state must stay its only owner
+    grabber = st.session_state["grabber"].grabber if "grabber" in st.session_state else None
+    if stop_btn and grabber is not None:
+        grabber.stop()
+        st.session_state.pop("grabber", None)
+        grabber = None
+    if start_btn:
+        if grabber is not None:
+            grabber.stop()
+        try:
+            grabber = FrameGrabber(stream_source).start()
+            # Only the session state holds the lease, so the camera is released when the session goes away
+            st.session_state["grabber"] = GrabberLease(grabber)
+        except Exception as e:
+            grabber = None
+            st.session_state.pop("grabber", None)
+            st.error(f"❌ Camera error: {str(e)}")
+
+    if grabber is not None:
+        # Filled by the capture loop at the end of the script, so the other tabs render while it streams
+        frame_slot = st.empty()
+        stats_slot = st.empty()
+        error_slot = st.empty()
+
+# -------------- Video Analysis Tab ----------------
+with tab3:
+    st.markdown("""
+        <div class="webcam-section">
+            <h3 style="color: white; margin-bottom: 1rem;">🎬 Video File Analysis</h3>
+            <p style="color: rgba(255,255,255,0.9); margin-bottom: 2rem;">Analyze dashcam or intersection footage frame by frame</p>
+        </div>
+    """, unsafe_allow_html=True)
+
+    uploaded_video = st.file_uploader(
+        "Choose a video file",
+        type=["mp4", "avi", "mov", "mkv"],
+        help="Upload a video to detect traffic elements in every analyzed frame"
+    )
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        frame_stride = st.slider("Analyze every Nth frame", min_value=1, max_value=30, value=1)
+    with col2:
+        video_batch_size = st.slider("Frames per batch", min_value=1, max_value=32, value=8)
+    with col3:
+        video_keyframes = st.slider(
+            "Run model every Nth analyzed frame", min_value=1, max_value=30, value=1,
+            help="Frames in between are tracked with optical flow instead of running the model"
+        )
+
+    if uploaded_video:
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col2:
+            video_btn = st.button("🎞️ Analyze Video", use_container_width=True)
+
+        if video_btn:
+            work_dir = tempfile.mkdtemp(prefix="traffic_video_")
+            video_in = os.path.join(work_dir, "input" + os.path.splitext(uploaded_video.name)[1])
+            video_out = os.path.join(work_dir, "annotated.mp4")
+            log_out = os.path.join(work_dir, "detections.csv")
+            with open(video_in, "wb") as f:
+                f.write(uploaded_video.getbuffer())
+
+            progress = st.progress(0.0)
+            status = st.empty()
+            preview = st.empty()
+            try:
+                for done, total, fps, annotated_frame, invocation_rate in analyze_video(
+                        backend, video_in, video_out, log_out, frame_stride, video_batch_size, video_keyframes,
+                        detection_log=detection_log, source=uploaded_video.name, **infer_params):
+                    if total:
+                        progress.progress(min(done / total, 1.0))
+                    status.caption(f"Frames analyzed: {done}/{total or '?'} | {fps:.1f} frames/sec | "
+                                   f"Model invocation rate: {invocation_rate:.0%}")
+                    preview.image(annotated_frame, channels="BGR", caption="Latest analyzed frame",
+                                  use_column_width=True)
+                progress.progress(1.0)
+                st.success("✅ Video analysis completed!")
+
+                col1, col2 = st.columns(2)
+                with col1:
+                    # Read into the button so the work directory can be removed when this run ends
+                    with open(video_out, "rb") as f:
+                        st.download_button(
+                            "📥 Download Annotated Video",
+                            f.read(),
+                            "traffic_analysis.mp4",
+                            "video/mp4",
+                            use_container_width=True
+                        )
+                with col2:
+                    with open(log_out, "rb") as f:
+                        st.download_button(
+                            "📥 Download Detection Log",
+                            f.read(),
+                            "traffic_detections.csv",
+                            "text/csv",
+                            use_container_width=True
+                        )
+
+            except ServiceBusy as e:
+                st.warning(f"⏳ {str(e)}")
+            except Exception as e:
+                st.error(f"❌ Error during video analysis: {str(e)}")
+
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+# -------------- Detection History Tab ----------------
+with tab4:
+    st.markdown("""
+        <div class="webcam-section">
+            <h3 style="color: white; margin-bottom: 1rem;">📊 Detection History</h3>
+            <p style="color: rgba(255,255,255,0.9); margin-bottom: 2rem;">Light-state patterns per camera over time from the detection log</p>
+        </div>
+    """, unsafe_allow_html=True)
+
+    if detection_log is None:
+        st.info("ℹ️ The detection log is disabled. Set TRAFFIC_DETECTION_LOG to a directory to enable it.")
+    else:
+        class_names = sorted(set(backend.names.values()))
+        col1, col2 = st.columns(2)
+        with col1:
+            history_classes = st.multiselect(
+                "Classes", class_names,
+                default=[name for name in class_names if "red" in name.lower()] or class_names[:1]
+            )
+        with col2:
+            history_hours = st.slider("Look back (hours)", min_value=1, max_value=24 * 7, value=24)
+
+        if st.button("🔄 Refresh"):
+            # Pending rows are flushed so the chart includes the last few seconds
+            detection_log.flush()
+            history_snapshot.clear()
+
+        counts, log_stats = history_snapshot(tuple(history_classes), history_hours)
+        st.caption(
+            f"Log: {log_stats['rows']} detections in {log_stats['segments']} segments from "
+            f"{log_stats['sources']} sources | {detection_log.written} written this session"
+        )
+        if not counts:
+            st.info("ℹ️ No matching detections in this time range yet.")
+        else:
+            hours = sorted({row["hour"] for row in counts})
+            sources = sorted({row["source"] for row in counts})
+            labels = [time.strftime("%m-%d %H:00", time.localtime(hour)) for hour in hours]
+            chart = {"Hour": labels, **{source: [0] * len(hours) for source in sources}}
+            for row in counts:
+                chart[row["source"]][hours.index(row["hour"])] = row["count"]
+            st.markdown(f"#### {' / '.join(history_classes)} detections per camera per hour")
+            st.bar_chart(chart, x="Hour", y=sources)
+            st.dataframe(
+                [{"Camera": row["source"], "Hour": time.strftime("%Y-%m-%d %H:00", time.localtime(row["hour"])),
+                  "Count": row["count"]} for row in counts],
+                use_container_width=True
+            )
+
 # -------------- Footer ----------------
 st.markdown('<hr class="divider">', unsafe_allow_html=True)
 st.markdown("""
@@ -564,3 +1385,71 @@ st.markdown("""
         </p>
     </div>
 """, unsafe_allow_html=True)
+
+# -------------- Live Stream Loop ----------------
+# Runs last: it only returns when the stream ends, and a widget click reruns the page and comes back here
+if grabber is not None:
+    keyframes = None
+    if stream_keyframes > 1:
+        keyframes = KeyframeDetector(backend, stream_keyframes, adaptive_keyframes, **infer_params)
+    st.session_state.pop("stream_gate", None)
+
+    def analyze_stream_frame(frame, timer):
+        # In overlay mode the plain frame is encoded and the browser draws the boxes
+        if keyframes is None:
+            return detect(backend, frame, timer, annotate=not overlay_results, **infer_params)
+        with timer.stage("infer"):
+            dets, is_keyframe = keyframes.process(frame)
+        if not overlay_results:
+            with timer.stage("annotate"):
+                frame = draw_detections(frame, dets)
+        with timer.stage("encode"):
+            annotated = encode_jpeg(frame)
+        timer.info["keyframe"] = is_keyframe
+        return dets, annotated
+    last_id = 0
+    shown = 0
+    started = time.perf_counter()
+    while grabber.running:
+        tick = time.perf_counter()
+        frame_id, frame = grabber.latest()
+        if frame is not None and frame_id != last_id:
+            last_id = frame_id
+            timer = RequestTimer(metrics, "stream")
+            if resolution_controller is not None:
+                # Re-read every frame so the stream follows the controller while it runs
+                infer_params["imgsz"] = resolution_controller.imgsz
+                if keyframes is not None:
+                    keyframes.params["imgsz"] = infer_params["imgsz"]
+            try:
+                (dets, annotated), skipped = motion_gated("stream_gate", frame, timer,
+                                                          lambda: analyze_stream_frame(frame, timer))
+            except ServiceBusy:
+                # Other sessions hold every model slot; drop this frame, the grabber keeps the next one fresh
+                time.sleep(1.0 / target_fps)
+                continue
+            invocation_rate = keyframes.invocation_rate if keyframes is not None else 1.0
+            gate = st.session_state.get("stream_gate")
+            if motion_gating and gate is not None:
+                invocation_rate *= 1 - gate.stats()["skip_rate"]
+            with timer.stage("render"):
+                if overlay_results:
+                    frame_slot.markdown(overlay_html(annotated, dets), unsafe_allow_html=True)
+                else:
+                    frame_slot.image(annotated, caption="Live Stream Analysis", use_column_width=True)
+            log_detections(stream_source, dets)
+            imgsz, total_ms = finish_request(timer, not skipped and timer.info.get("keyframe", True),
+                                             detections=len(dets), dropped=grabber.dropped)
+            shown += 1
+            elapsed = time.perf_counter() - started
+            stats_slot.caption(
+                f"Frames analyzed: {shown} | Achieved FPS: {shown / elapsed:.1f} | "
+                f"Model invocation rate: {invocation_rate:.0%} | "
+                f"Static frames skipped: {st.session_state['stream_gate'].skips if motion_gating else 0} | "
+                f"Stale frames dropped: {grabber.dropped} | Detections: {len(dets)} | "
+                f"Size: {imgsz} px | Latency: {total_ms:.0f} ms"
+            )
+        time.sleep(max(0.0, 1.0 / target_fps - (time.perf_counter() - tick)))
+    if grabber.error:
+        error_slot.error(f"❌ Camera error: {grabber.error}")
+    st.session_state.pop("grabber", None)
@@ -0,0 +1,192 @@
+import json
+import os
+import shutil
+import tempfile
+
+import cv2
+import numpy as np
+
+from detection import Detections, LocalBackend, file_digest
+
+# pytorch runs best.pt through Ultralytics; pytorch-mmap runs a float32 snapshot whose weights are memory-mapped,
+# so every process on the box shares one copy through the page cache; the others run a cached export without torch
+BACKENDS = ["pytorch", "pytorch-mmap", "onnx", "onnx-int8", "openvino"]
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".model_cache")
+
+
+# -------------- Export Cache ----------------
+def export_model(weights, backend, cache_dir=DEFAULT_CACHE_DIR):
+    # Exports once per weights hash; later calls (and restarts) reuse the cached artifact
+    digest = file_digest(weights)
+    target = os.path.join(cache_dir, f"{digest}-{backend}")
+    if os.path.exists(os.path.join(target, "names.json")):
+        return target
+
+    from ultralytics import YOLO
+
+    os.makedirs(cache_dir, exist_ok=True)
+    work = tempfile.mkdtemp(prefix="export-", dir=cache_dir)
+    try:
+        local_weights = os.path.join(work, "model.pt")
+        shutil.copyfile(weights, local_weights)
+        model = YOLO(local_weights)
+        fmt = "openvino" if backend == "openvino" else "onnx"
+        # dynamic axes keep batching and the imgsz setting usable after export
+        exported = model.export(format=fmt, dynamic=True, simplify=fmt == "onnx")
+        out = os.path.join(work, "out")
+        os.makedirs(out)
+        if backend == "openvino":
+            for name in os.listdir(exported):
+                shutil.move(os.path.join(exported, name), out)
+        elif backend == "onnx-int8":
+            try:
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+            except ImportError:
+                raise ImportError("onnx-int8 needs onnxruntime: pip install onnxruntime")
+            quantize_dynamic(exported, os.path.join(out, "model.onnx"), weight_type=QuantType.QUInt8)
+        else:
+            shutil.move(exported, os.path.join(out, "model.onnx"))
+        with open(os.path.join(out, "names.json"), "w") as f:
+            json.dump({str(k): v for k, v in model.names.items()}, f)
+        os.replace(out, target)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return target
+
+
+def snapshot_model(weights, cache_dir=DEFAULT_CACHE_DIR):
+    # Fused float32 copy of the checkpoint's module: Ultralytics stores half-precision weights, and
+    # converting them at load time would give every process its own private float32 copy
+    digest = file_digest(weights)
+    target = os.path.join(cache_dir, f"{digest}-fp32.pt")
+    if os.path.exists(target):
+        return target
+
+    import torch
+
+    os.makedirs(cache_dir, exist_ok=True)
+    ckpt = torch.load(weights, map_location="cpu", weights_only=False)
+    model = (ckpt.get("ema") or ckpt["model"]).float().fuse(verbose=False).eval()
+    fd, tmp = tempfile.mkstemp(prefix="snapshot-", suffix=".pt", dir=cache_dir)
+    os.close(fd)
+    torch.save({"model": model, "names": dict(model.names)}, tmp)
+    os.replace(tmp, target)
+    return target
+
+
+# -------------- Pre/Post-processing ----------------
+def letterbox(frame, size):
+    h, w = frame.shape[:2]
+    ratio = min(size / h, size / w)
+    new_w, new_h = round(w * ratio), round(h * ratio)
+    pad_x, pad_y = (size - new_w) / 2, (size - new_h) / 2
+    resized = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    top, left = round(pad_y - 0.1), round(pad_x - 0.1)
+    canvas = cv2.copyMakeBorder(resized, top, size - new_h - top, left, size - new_w - left,
+                                cv2.BORDER_CONSTANT, value=(114, 114, 114))
+    return canvas, ratio, (left, top)
+
+
+def postprocess(pred, ratio, pad, orig_shape, names, conf=0.25, iou=0.7, max_det=300):
+    # pred: (4 + num_classes, anchors) raw YOLOv8 head output for one image
+    pred = pred.T
+    scores = pred[:, 4:]
+    cls = scores.argmax(1)
+    best = scores[np.arange(len(cls)), cls]
+    keep = best > conf
+    boxes, best, cls = pred[keep, :4], best[keep], cls[keep]
+    xywh = boxes.copy()
+    xywh[:, :2] -= xywh[:, 2:] / 2
+    idx = cv2.dnn.NMSBoxesBatched(xywh.tolist(), best.tolist(), cls.tolist(), conf, iou) if len(best) else []
+    idx = np.asarray(idx, dtype=int).reshape(-1)[:max_det]
+    xyxy = np.concatenate([xywh[idx, :2], xywh[idx, :2] + xywh[idx, 2:]], axis=1)
+    xyxy[:, [0, 2]] = ((xyxy[:, [0, 2]] - pad[0]) / ratio).clip(0, orig_shape[1])
+    xyxy[:, [1, 3]] = ((xyxy[:, [1, 3]] - pad[1]) / ratio).clip(0, orig_shape[0])
+    return Detections(xyxy, best[idx], cls[idx], names, orig_shape)
+
+
+# -------------- Exported Backends ----------------
+class ExportedBackend:
+    # Same predict() contract as LocalBackend, on top of an ONNX Runtime or OpenVINO session
+    def __init__(self, weights, backend, cache_dir=DEFAULT_CACHE_DIR, threads=None):
+        path = export_model(weights, backend, cache_dir)
+        with open(os.path.join(path, "names.json")) as f:
+            self.names = {int(k): v for k, v in json.load(f).items()}
+        self.weights_hash = f"{file_digest(weights)}-{backend}"
+        if backend == "openvino":
+            try:
+                import openvino as ov
+            except ImportError:
+                raise ImportError("The openvino backend needs OpenVINO: pip install openvino")
+            xml = next(name for name in os.listdir(path) if name.endswith(".xml"))
+            config = {"INFERENCE_NUM_THREADS": threads} if threads else {}
+            compiled = ov.Core().compile_model(os.path.join(path, xml), "CPU", config)
+            self._run = lambda batch: compiled(batch)[0]
+        else:
+            try:
+                import onnxruntime as ort
+            except ImportError:
+                raise ImportError("The onnx backends need ONNX Runtime: pip install onnxruntime")
+            options = ort.SessionOptions()
+            if threads:
+                options.intra_op_num_threads = threads
+            session = ort.InferenceSession(os.path.join(path, "model.onnx"), options,
+                                           providers=["CPUExecutionProvider"])
+            input_name = session.get_inputs()[0].name
+            self._run = lambda batch: session.run(None, {input_name: batch})[0]
+
+    def warmup(self, imgsz=640):
+        self.predict([np.zeros((imgsz, imgsz, 3), dtype=np.uint8)], imgsz=imgsz)
+
+    def predict(self, frames, batch_size=8, conf=0.25, iou=0.7, imgsz=640, max_det=300):
+        imgsz = max(32, int(imgsz) // 32 * 32)
+        detections = []
+        for start in range(0, len(frames), batch_size):
+            chunk = frames[start:start + batch_size]
+            boxed = [letterbox(frame, imgsz) for frame in chunk]
+            batch = np.stack([canvas[:, :, ::-1].transpose(2, 0, 1) for canvas, _, _ in boxed])
+            preds = self._run(np.ascontiguousarray(batch, dtype=np.float32) / 255.0)
+            for frame, (_, ratio, pad), pred in zip(chunk, boxed, preds):
+                detections.append(postprocess(pred, ratio, pad, frame.shape[:2], self.names, conf, iou, max_det))
+        return detections
+
+
+class MmapTorchBackend(ExportedBackend):
+    # Raw YOLOv8 module on memory-mapped weights, with the same letterbox/postprocess as the exports.
+    # Pages are read-only and file-backed, so N processes cost one copy of the weights, not N.
+    def __init__(self, weights, cache_dir=DEFAULT_CACHE_DIR, threads=None):
+        import torch
+
+        if threads:
+            torch.set_num_threads(threads)
+        path = snapshot_model(weights, cache_dir)
+        try:
+            ckpt = torch.load(path, map_location="cpu", mmap=True, weights_only=False)
+        except TypeError:
+            # torch < 2.1 has no mmap: still works, just without the sharing
+            ckpt = torch.load(path, map_location="cpu")
+        module = ckpt["model"]
+        self.names = {int(k): v for k, v in ckpt["names"].items()}
+        self.weights_hash = f"{file_digest(weights)}-pytorch-mmap"
+
+        def run(batch):
+            with torch.inference_mode():
+                out = module(torch.from_numpy(batch))
+            # eval-mode Detect returns (decoded predictions, raw feature maps)
+            return (out[0] if isinstance(out, (list, tuple)) else out).numpy()
+
+        self._run = run
+
+
+def load_backend(weights, backend="pytorch", threads=None, cache_dir=DEFAULT_CACHE_DIR):
+    # One entry point for the CLIs, worker processes and the model registry; threads caps the intra-op pool
+    if backend == "pytorch-mmap":
+        return MmapTorchBackend(weights, cache_dir, threads)
+    if backend == "pytorch":
+        import torch
+        from ultralytics import YOLO
+
+        if threads:
+            torch.set_num_threads(threads)
+        return LocalBackend(YOLO(weights), file_digest(weights))
+    return ExportedBackend(weights, backend, cache_dir, threads)
@@ -0,0 +1,233 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from backends import BACKENDS, load_backend
+from detection import decode_reduced, draw_detections, encode_jpeg, file_digest
+from streams import SyntheticSource
+
+BUNDLED_IMAGES = ["webcam.jpg", "output.jpg"]
+# The bundled images live next to this script, so the "bundled" case exists whatever the working directory
+BUNDLED_ROOT = os.path.dirname(os.path.abspath(__file__))
+STAGES = ["decode", "infer", "annotate", "encode"]
+
+
+# -------------- Inputs ----------------
+def load_inputs(resolutions, root=BUNDLED_ROOT):
+    # Everything is kept as encoded JPEG bytes so the decode stage matches an upload
+    inputs = {}
+    bundled = [os.path.join(root, name) for name in BUNDLED_IMAGES if os.path.exists(os.path.join(root, name))]
+    if bundled:
+        inputs["bundled"] = []
+        for path in bundled:
+            with open(path, "rb") as f:
+                inputs["bundled"].append(f.read())
+    for width, height in resolutions:
+        source = SyntheticSource(width, height)
+        rng = np.random.default_rng(width * height)
+        images = []
+        for _ in range(4):
+            _, frame = source.read()
+            noise = rng.integers(0, 25, frame.shape, dtype=np.uint8)
+            images.append(encode_jpeg(cv2.add(frame, noise)))
+        inputs[f"synthetic_{width}x{height}"] = images
+    return inputs
+
+
+# -------------- Measurement ----------------
+def percentiles(samples):
+    samples = np.asarray(samples, dtype=np.float64)
+    return {
+        "mean": round(float(samples.mean()), 3),
+        "p50": round(float(np.percentile(samples, 50)), 3),
+        "p95": round(float(np.percentile(samples, 95)), 3),
+        "p99": round(float(np.percentile(samples, 99)), 3),
+    }
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_case(backend, images, batch_size, iterations, warmup, params, decode_target=None):
+    stages = {stage: [] for stage in STAGES}
+    latencies = []
+    model_stages = {}
+    processed = 0
+    total_time = 0.0
+    for i in range(warmup + iterations):
+        blobs = [images[(i * batch_size + j) % len(images)] for j in range(batch_size)]
+
+        t0 = time.perf_counter()
+        frames = [decode_reduced(data, decode_target)[0] for data in blobs]
+        t1 = time.perf_counter()
+        detections = backend.predict(frames, batch_size=batch_size, **params)
+        t2 = time.perf_counter()
+        annotated = [draw_detections(frame, dets) for frame, dets in zip(frames, detections)]
+        t3 = time.perf_counter()
+        for frame in annotated:
+            encode_jpeg(frame)
+        t4 = time.perf_counter()
+
+        if i < warmup:
+            continue
+        timings = {"decode": t1 - t0, "infer": t2 - t1, "annotate": t3 - t2, "encode": t4 - t3}
+        for stage, seconds in timings.items():
+            stages[stage].append(seconds * 1000)
+        latencies.append((t4 - t0) * 1000)
+        # Ultralytics splits infer into preprocess / inference / postprocess (NMS) per image
+        for dets in detections:
+            for stage, ms in dets.speed.items():
+                model_stages.setdefault(stage, []).append(ms)
+        processed += batch_size
+        total_time += t4 - t0
+
+    return {
+        "batch_size": batch_size,
+        "iterations": iterations,
+        "batch_latency_ms": percentiles(latencies),
+        "per_image_latency_ms": percentiles(np.asarray(latencies) / batch_size),
+        "stages_ms": {stage: percentiles(samples) for stage, samples in stages.items()},
+        "model_stages_ms": {stage: percentiles(samples) for stage, samples in model_stages.items()},
+        "images_per_sec": round(processed / total_time, 2),
+    }
+
+
+def environment(args):
+    versions = {"python": platform.python_version(), "numpy": np.__version__, "opencv": cv2.__version__}
+    for module in ("torch", "ultralytics", "onnxruntime", "openvino"):
+        if module in sys.modules:
+            versions[module] = getattr(sys.modules[module], "__version__", "unknown")
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "versions": versions,
+        "backend": args.backend,
+        "weights_hash": file_digest(args.weights),
+        "params": {"conf": args.conf, "iou": args.iou, "imgsz": args.imgsz, "reduced_decode": args.reduced_decode},
+    }
+
+
+# -------------- Baseline Comparison ----------------
+def incomparable(current, baseline):
+    # Numbers from another backend, model or input setup say nothing about a regression in this one
+    env, base_env = current["environment"], baseline.get("environment", {})
+    problems = []
+    for field in ("backend", "weights_hash"):
+        if env[field] != base_env.get(field):
+            problems.append(f"{field}: {base_env.get(field)} -> {env[field]}")
+    for field in ("imgsz", "reduced_decode", "conf", "iou"):
+        before = base_env.get("params", {}).get(field)
+        if env["params"][field] != before:
+            problems.append(f"{field}: {before} -> {env['params'][field]}")
+    return problems
+
+
+def compare(current, baseline, tolerance):
+    regressions = []
+    for name, cases in current["cases"].items():
+        base_cases = {c["batch_size"]: c for c in baseline.get("cases", {}).get(name, [])}
+        for case in cases:
+            base = base_cases.get(case["batch_size"])
+            if base is None:
+                continue
+            label = f"{name} batch={case['batch_size']}"
+            for pct in ("p50", "p95", "p99"):
+                now, before = case["per_image_latency_ms"][pct], base["per_image_latency_ms"][pct]
+                if now > before * (1 + tolerance):
+                    regressions.append(f"{label}: {pct} latency {before:.1f} -> {now:.1f} ms")
+            now, before = case["images_per_sec"], base["images_per_sec"]
+            if now < before * (1 - tolerance):
+                regressions.append(f"{label}: throughput {before:.1f} -> {now:.1f} images/sec")
+    if current["peak_rss_mb"] > baseline.get("peak_rss_mb", float("inf")) * (1 + tolerance):
+        regressions.append(f"peak RSS {baseline['peak_rss_mb']:.0f} -> {current['peak_rss_mb']:.0f} MB")
+    return regressions
+
+
+def parse_resolution(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency/throughput benchmark for the detection pipeline")
+    parser.add_argument("--weights", default="best.pt")
+    parser.add_argument("--backend", default="pytorch", choices=BACKENDS)
+    parser.add_argument("--resolutions", default="640x480,1280x720,1920x1080,3840x2160",
+                        help="Comma separated WxH list of synthetic inputs")
+    parser.add_argument("--batch-sizes", default="1,4,8")
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--conf", type=float, default=0.25)
+    parser.add_argument("--iou", type=float, default=0.7)
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--reduced-decode", action="store_true",
+                        help="Decode JPEGs in draft mode near --imgsz, as the upload tab does")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="Earlier results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative slowdown before flagging")
+    args = parser.parse_args()
+
+    resolutions = [parse_resolution(r) for r in args.resolutions.split(",") if r]
+    batch_sizes = [int(b) for b in args.batch_sizes.split(",") if b]
+    params = {"conf": args.conf, "iou": args.iou, "imgsz": args.imgsz}
+
+    load_started = time.perf_counter()
+    backend = load_backend(args.weights, args.backend)
+    load_seconds = time.perf_counter() - load_started
+    warmup_started = time.perf_counter()
+    backend.warmup(args.imgsz)
+    warmup_seconds = time.perf_counter() - warmup_started
+    inputs = load_inputs(resolutions)
+
+    results = {"environment": environment(args), "model_load_s": round(load_seconds, 3),
+               "warmup_s": round(warmup_seconds, 3), "cases": {}}
+    for name, images in inputs.items():
+        results["cases"][name] = []
+        for batch_size in batch_sizes:
+            case = run_case(backend, images, batch_size, args.iterations, args.warmup, params,
+                            args.imgsz if args.reduced_decode else None)
+            results["cases"][name].append(case)
+            lat = case["per_image_latency_ms"]
+            print(f"{name:>26} batch={batch_size:<3} p50={lat['p50']:8.1f}ms p95={lat['p95']:8.1f}ms "
+                  f"p99={lat['p99']:8.1f}ms {case['images_per_sec']:8.1f} img/s")
+    results["peak_rss_mb"] = peak_rss_mb()
+    print(f"Peak RSS: {results['peak_rss_mb']} MB")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        problems = incomparable(results, baseline)
+        if problems:
+            print("Not comparing against the baseline, the runs differ in:")
+            for line in problems:
+                print(f"  - {line}")
+            sys.exit(2)
+        for name in sorted(set(results["cases"]) ^ set(baseline.get("cases", {}))):
+            side = "this run" if name in baseline.get("cases", {}) else "the baseline"
+            print(f"Warning: case {name} is missing from {side} and is not compared")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions against baseline:")
+            for line in regressions:
+                print(f"  - {line}")
+            sys.exit(1)
+        print("No regressions against baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+from detection import ServiceBusy
+
+
+# -------------- Thread Budget ----------------
+def parse_cores(spec):
+    # "0-3,6" -> {0, 1, 2, 3, 6}
+    cores = set()
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        start, _, end = part.partition("-")
+        cores.update(range(int(start), int(end or start) + 1))
+    return cores
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def configure_threads(torch_threads=None, opencv_threads=None, cores=None):
+    # Pin first so the thread defaults below are derived from the cores this process may use.
+    # Returns what was applied; torch is only configured if it is already imported, so calling
+    # this never drags torch into a process that runs an ONNX/OpenVINO backend.
+    applied = {}
+    if cores:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, parse_cores(cores) if isinstance(cores, str) else set(cores))
+            applied["cores"] = sorted(os.sched_getaffinity(0))
+        else:
+            applied["cores"] = "unsupported on this platform"
+    if opencv_threads is not None:
+        cv2.setNumThreads(int(opencv_threads))
+        applied["opencv_threads"] = cv2.getNumThreads()
+    if torch_threads is not None and "torch" in sys.modules:
+        torch = sys.modules["torch"]
+        torch.set_num_threads(int(torch_threads))
+        try:
+            # Only settable before the first parallel op; later calls raise and keep the old value
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass
+        applied["torch_threads"] = torch.get_num_threads()
+    return applied
+
+
+# -------------- Admission Control ----------------
+class AdmissionBackend:
+    # Wraps any backend with a bounded number of concurrent predict() calls and a bounded wait queue.
+    # Callers beyond max_waiting (or waiting longer than timeout) get ServiceBusy instead of piling up,
+    # so latency for admitted requests stays flat as sessions are added.
+    def __init__(self, backend, max_in_flight=2, max_waiting=8, timeout=30.0, metrics=None):
+        self.backend = backend
+        self.max_in_flight = max_in_flight
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.metrics = metrics
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        if metrics is not None:
+            metrics.set_gauge("inference_in_flight", lambda: self.in_flight)
+            metrics.set_gauge("inference_waiting", lambda: self.waiting)
+
+    def __getattr__(self, name):
+        # names, weights_hash, warmup() and friends come from the wrapped backend
+        return getattr(self.backend, name)
+
+    def _reject(self, reason):
+        with self._lock:
+            self.rejected += 1
+        if self.metrics is not None:
+            self.metrics.inc("admission_rejected_total", reason=reason)
+        raise ServiceBusy("The model is busy with other requests, please retry in a moment")
+
+    def predict(self, frames, batch_size=8, **params):
+        with self._lock:
+            full = self.waiting >= self.max_waiting and self.in_flight >= self.max_in_flight
+            if not full:
+                self.waiting += 1
+        if full:
+            self._reject("queue_full")
+        started = time.perf_counter()
+        acquired = self._slots.acquire(timeout=self.timeout)
+        with self._lock:
+            self.waiting -= 1
+            if acquired:
+                self.in_flight += 1
+                self.admitted += 1
+        if not acquired:
+            self._reject("timeout")
+        if self.metrics is not None:
+            self.metrics.observe("admission_wait_seconds", time.perf_counter() - started)
+        try:
+            return self.backend.predict(frames, batch_size=batch_size, **params)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "max_in_flight": self.max_in_flight,
+                "max_waiting": self.max_waiting,
+            }
+
+
+# -------------- Latency SLO ----------------
+RESOLUTION_STEPS = (1280, 960, 800, 640, 512, 416, 320)
+
+
+class ResolutionController:
+    # Steps imgsz down (640 -> 512 -> 416 -> 320) while recent p90 latency exceeds the target and back
+    # up when the larger size is predicted to fit. Cost grows roughly with pixel count, so the
+    # prediction scales the current p90 by the squared size ratio. The window is cleared after each
+    # step so decisions only use samples taken at the current size.
+    def __init__(self, target_ms, max_imgsz=640, min_imgsz=320, window=20, min_samples=5, headroom=0.8):
+        self.target_ms = target_ms
+        self.sizes = [s for s in RESOLUTION_STEPS if min_imgsz <= s <= max_imgsz] or [max_imgsz]
+        if max_imgsz not in self.sizes:
+            self.sizes.insert(0, max_imgsz)
+        self.min_samples = min_samples
+        self.headroom = headroom
+        self.index = 0
+        self.steps_down = 0
+        self.steps_up = 0
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    @property
+    def imgsz(self):
+        return self.sizes[self.index]
+
+    def observe(self, latency_ms):
+        with self._lock:
+            self._samples.append(latency_ms)
+            if len(self._samples) < self.min_samples:
+                return self.sizes[self.index]
+            p90 = float(np.percentile(self._samples, 90))
+            if p90 > self.target_ms and self.index < len(self.sizes) - 1:
+                self.index += 1
+                self.steps_down += 1
+                self._samples.clear()
+            elif self.index > 0:
+                scale = (self.sizes[self.index - 1] / self.sizes[self.index]) ** 2
+                if p90 * scale < self.target_ms * self.headroom:
+                    self.index -= 1
+                    self.steps_up += 1
+                    self._samples.clear()
+            return self.sizes[self.index]
+
+    def stats(self):
+        with self._lock:
+            samples = list(self._samples)
+            return {
+                "imgsz": self.sizes[self.index],
+                "target_ms": self.target_ms,
+                "p50_ms": round(float(np.percentile(samples, 50)), 1) if samples else None,
+                "p90_ms": round(float(np.percentile(samples, 90)), 1) if samples else None,
+                "steps_down": self.steps_down,
+                "steps_up": self.steps_up,
+            }
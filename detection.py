@@ -0,0 +1,471 @@
+import base64
+import csv
+import hashlib
+import html
+import io
+import json
+import math
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+
+# -------------- In-memory Image Helpers ----------------
+def pil_to_bgr(img):
+    # Ultralytics treats ndarray input as BGR, same as cv2.imread
+    rgb = np.asarray(img.convert("RGB"))
+    return np.ascontiguousarray(rgb[:, :, ::-1])
+
+
+def encode_jpeg(frame, quality=90):
+    ok, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("JPEG encoding failed")
+    return buf.tobytes()
+
+
+# -------------- Detection Results ----------------
+class Detections:
+    # Plain NumPy view of one image's boxes, independent of where inference ran
+    def __init__(self, xyxy, conf, cls, names, orig_shape, speed=None, info=None, ids=None):
+        self.xyxy = np.asarray(xyxy, dtype=np.float32).reshape(-1, 4)
+        self.conf = np.asarray(conf, dtype=np.float32).reshape(-1)
+        self.cls = np.asarray(cls, dtype=np.int64).reshape(-1)
+        self.names = names
+        self.orig_shape = tuple(orig_shape)
+        self.speed = speed or {}
+        # Extra facts about how the result was produced (e.g. tiling), shown next to it
+        self.info = info or {}
+        # Track ids when the boxes come from a tracker
+        self.ids = None if ids is None else np.asarray(ids, dtype=np.int64).reshape(-1)
+
+    @classmethod
+    def from_result(cls, result):
+        # One device-to-host transfer for the whole (N, 6) box tensor
+        data = result.boxes.data.cpu().numpy() if result.boxes is not None else np.zeros((0, 6))
+        return cls(data[:, :4], data[:, 4], data[:, 5], result.names, result.orig_shape, result.speed)
+
+    def __len__(self):
+        return len(self.cls)
+
+    @property
+    def nbytes(self):
+        return self.xyxy.nbytes + self.conf.nbytes + self.cls.nbytes
+
+    def labels(self):
+        return [self.names[int(c)] for c in self.cls]
+
+    def filter(self, min_conf):
+        # Client-side thresholding: a stricter conf never needs another model call
+        keep = self.conf >= min_conf
+        ids = None if self.ids is None else self.ids[keep]
+        return Detections(self.xyxy[keep], self.conf[keep], self.cls[keep], self.names, self.orig_shape,
+                          self.speed, self.info, ids)
+
+    def rescaled(self, shape):
+        # Same boxes in the coordinates of an image of the given (height, width)
+        sy, sx = shape[0] / self.orig_shape[0], shape[1] / self.orig_shape[1]
+        xyxy = self.xyxy * np.array([sx, sy, sx, sy], dtype=np.float32)
+        return Detections(xyxy, self.conf, self.cls, self.names, shape, self.speed, self.info, self.ids)
+
+    def class_summary(self):
+        # Per-class count / mean / max confidence, sorted by count
+        if not len(self):
+            return []
+        ids, inverse, counts = np.unique(self.cls, return_inverse=True, return_counts=True)
+        mean = np.bincount(inverse, weights=self.conf) / counts
+        best = np.zeros(len(ids), dtype=np.float32)
+        np.maximum.at(best, inverse, self.conf)
+        order = np.argsort(-counts, kind="stable")
+        return [
+            {"class": self.names[int(ids[i])], "count": int(counts[i]),
+             "mean_conf": float(mean[i]), "max_conf": float(best[i])}
+            for i in order
+        ]
+
+    def columns(self):
+        # Column-oriented table, rendered in one frontend message
+        order = np.argsort(-self.conf, kind="stable")
+        xyxy = self.xyxy[order].round(1)
+        table = {
+            "Class": [self.names[int(c)] for c in self.cls[order]],
+            "Confidence": (self.conf[order] * 100).round(1),
+            "x1": xyxy[:, 0], "y1": xyxy[:, 1], "x2": xyxy[:, 2], "y2": xyxy[:, 3],
+        }
+        if self.ids is not None:
+            table = {"Track": self.ids[order], **table}
+        return table
+
+    def to_dict(self):
+        return {
+            "xyxy": self.xyxy.round(1).tolist(),
+            "conf": self.conf.round(4).tolist(),
+            "cls": self.cls.tolist(),
+            "orig_shape": list(self.orig_shape),
+            "speed": self.speed,
+            "info": self.info,
+            "ids": None if self.ids is None else self.ids.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data, names):
+        return cls(data["xyxy"], data["conf"], data["cls"], names, data["orig_shape"], data.get("speed"),
+                   data.get("info"), data.get("ids"))
+
+
+def class_color(index):
+    # Stable, well separated BGR colour per class id
+    hue = (index * 47) % 180
+    hsv = np.uint8([[[hue, 220, 255]]])
+    return tuple(int(v) for v in cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)[0, 0])
+
+
+def draw_detections(frame, dets):
+    annotated = frame.copy()
+    thickness = max(2, round(sum(frame.shape[:2]) / 600))
+    scale = thickness / 3
+    ids = dets.ids if dets.ids is not None else [None] * len(dets)
+    for (x1, y1, x2, y2), conf, c, track_id in zip(dets.xyxy.astype(int), dets.conf, dets.cls, ids):
+        color = class_color(int(c))
+        label = f"{dets.names[int(c)]} {conf:.2f}"
+        if track_id is not None:
+            label = f"#{track_id} {label}"
+        cv2.rectangle(annotated, (x1, y1), (x2, y2), color, thickness, cv2.LINE_AA)
+        (tw, th), _ = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, scale, max(thickness - 1, 1))
+        top = y1 - th - 6 if y1 - th - 6 >= 0 else y1
+        cv2.rectangle(annotated, (x1, top), (x1 + tw + 4, top + th + 6), color, -1, cv2.LINE_AA)
+        cv2.putText(annotated, label, (x1 + 2, top + th + 2), cv2.FONT_HERSHEY_SIMPLEX, scale,
+                    (255, 255, 255), max(thickness - 1, 1), cv2.LINE_AA)
+    return annotated
+
+
+def overlay_html(image, dets, mime="image/jpeg"):
+    # The image with boxes in an SVG layer the browser draws on top: no server-side annotate pass.
+    # viewBox is the original pixel grid, so boxes line up with a display-sized copy of the image at
+    # any display width. Both are upright: orig_shape is taken after EXIF rotation (decode_reduced).
+    h, w = dets.orig_shape
+    font = max(12, round((h + w) / 100))
+    ids = dets.ids if dets.ids is not None else [None] * len(dets)
+    shapes = []
+    for (x1, y1, x2, y2), conf, c, track_id in zip(dets.xyxy.round(1).tolist(), dets.conf, dets.cls, ids):
+        b, g, r = class_color(int(c))
+        color = f"#{r:02x}{g:02x}{b:02x}"
+        label = f"{dets.names[int(c)]} {conf:.2f}"
+        if track_id is not None:
+            label = f"#{track_id} {label}"
+        top = y1 - font * 1.3 if y1 - font * 1.3 >= 0 else y1
+        shapes.append(
+            f'<rect x="{x1}" y="{y1}" width="{x2 - x1:.1f}" height="{y2 - y1:.1f}" fill="none" stroke="{color}" '
+            f'stroke-width="2" vector-effect="non-scaling-stroke"/>'
+            f'<rect x="{x1}" y="{top:.1f}" width="{len(label) * font * 0.6:.1f}" height="{font * 1.3:.1f}" '
+            f'fill="{color}"/>'
+            f'<text x="{x1 + 2}" y="{top + font:.1f}" font-size="{font}" fill="#fff" '
+            f'font-family="sans-serif">{html.escape(label)}</text>'
+        )
+    data = base64.b64encode(image).decode()
+    return (
+        '<div style="position: relative; width: 100%; line-height: 0;">'
+        f'<img src="data:{mime};base64,{data}" style="width: 100%; display: block; border-radius: 10px; '
+        'image-orientation: from-image;"/>'
+        f'<svg viewBox="0 0 {w} {h}" preserveAspectRatio="none" '
+        'style="position: absolute; top: 0; left: 0; width: 100%; height: 100%; pointer-events: none;">'
+        + "".join(shapes) + "</svg></div>"
+    )
+
+
+# -------------- Inference Backends ----------------
+class LocalBackend:
+    # Runs the YOLO model in this process
+    def __init__(self, model, weights_hash=""):
+        self.model = model
+        self.names = model.names
+        self.weights_hash = weights_hash
+
+    def predict(self, frames, batch_size=8, **params):
+        # Ultralytics letterboxes every frame in the list to the same input and runs them as one tensor
+        detections = []
+        for start in range(0, len(frames), batch_size):
+            results = self.model(frames[start:start + batch_size], verbose=False, **params)
+            detections.extend(Detections.from_result(r) for r in results)
+        return detections
+
+    def warmup(self, imgsz=640):
+        self.predict([np.zeros((imgsz, imgsz, 3), dtype=np.uint8)], imgsz=imgsz)
+
+
+class ServiceBusy(RuntimeError):
+    pass
+
+
+class RemoteBackend:
+    # Thin client for server.py; concurrent requests let the service micro-batch them
+    def __init__(self, url, timeout=60, workers=8):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.workers = workers
+        info = self._get("/info")
+        self.names = {int(k): v for k, v in info["names"].items()}
+        self.weights_hash = info["weights_hash"]
+
+    def _get(self, path):
+        with urllib.request.urlopen(self.url + path, timeout=self.timeout) as resp:
+            return json.loads(resp.read())
+
+    def _predict_one(self, frame, params):
+        # Raw pixels avoid an encode/decode round trip on the local link
+        frame = np.ascontiguousarray(frame)
+        query = urllib.parse.urlencode({"shape": ",".join(map(str, frame.shape)), **params})
+        req = urllib.request.Request(
+            f"{self.url}/detect?{query}",
+            data=frame.tobytes(),
+            headers={"Content-Type": "application/octet-stream"},
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                return Detections.from_dict(json.loads(resp.read()), self.names)
+        except urllib.error.HTTPError as e:
+            if e.code == 503:
+                raise ServiceBusy("Inference service is busy, please retry") from e
+            raise
+
+    def warmup(self, imgsz=640):
+        # The service warms its own model; this only checks it is reachable
+        self._get("/health")
+
+    def predict(self, frames, batch_size=8, **params):
+        if len(frames) == 1:
+            return [self._predict_one(frames[0], params)]
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(frames))) as pool:
+            return list(pool.map(lambda f: self._predict_one(f, params), frames))
+
+
+def timed(timer, name):
+    return timer.stage(name) if timer is not None else nullcontext()
+
+
+def detect(backend, frame, timer=None, annotate=True, **params):
+    # Returns the detections plus the annotated image as JPEG bytes; params are conf/iou/imgsz.
+    # annotate=False encodes the plain frame instead, for callers that draw the boxes client-side.
+    with timed(timer, "infer"):
+        dets = backend.predict([frame], **params)[0]
+    if annotate:
+        with timed(timer, "annotate"):
+            frame = draw_detections(frame, dets)
+    with timed(timer, "encode"):
+        return dets, encode_jpeg(frame)
+
+
+# -------------- Tiled Inference ----------------
+def tile_origins(length, tile, stride):
+    if length <= tile:
+        return [0]
+    origins = list(range(0, length - tile, stride))
+    # Last tile is aligned to the far edge so nothing is cut off
+    return origins + [length - tile]
+
+
+def merge_detections(parts, names, orig_shape, iou=0.5):
+    xyxy = np.concatenate([p.xyxy for p in parts]) if parts else np.zeros((0, 4))
+    conf = np.concatenate([p.conf for p in parts]) if parts else np.zeros(0)
+    cls = np.concatenate([p.cls for p in parts]) if parts else np.zeros(0, dtype=np.int64)
+    if len(conf) == 0:
+        return Detections(xyxy, conf, cls, names, orig_shape)
+    # Cross-tile NMS: the same light seen by two overlapping tiles collapses to one box
+    xywh = np.concatenate([xyxy[:, :2], xyxy[:, 2:] - xyxy[:, :2]], axis=1)
+    keep = cv2.dnn.NMSBoxesBatched(xywh.tolist(), conf.tolist(), cls.tolist(), 0.0, iou)
+    keep = np.asarray(keep, dtype=int).reshape(-1)
+    return Detections(xyxy[keep], conf[keep], cls[keep], names, orig_shape)
+
+
+def tiled_predict(backend, frame, tile_size=640, overlap=0.2, tile_batch=8, full_pass=True, merge_iou=0.5,
+                  **params):
+    # Runs overlapping tile_size crops at native resolution so small distant lights keep their pixels.
+    # Only tile_batch crops are in flight at once; the crops themselves are views into frame.
+    height, width = frame.shape[:2]
+    if height <= tile_size and width <= tile_size:
+        return backend.predict([frame], **params)[0]
+
+    stride = max(1, int(tile_size * (1 - overlap)))
+    origins = [(x, y) for y in tile_origins(height, tile_size, stride) for x in tile_origins(width, tile_size, stride)]
+    tile_params = {**params, "imgsz": tile_size}
+    parts, batch_ms = [], []
+    for start in range(0, len(origins), tile_batch):
+        chunk = origins[start:start + tile_batch]
+        tiles = [frame[y:y + tile_size, x:x + tile_size] for x, y in chunk]
+        started = time.perf_counter()
+        results = backend.predict(tiles, batch_size=len(tiles), **tile_params)
+        batch_ms.append((time.perf_counter() - started) * 1000)
+        for (x, y), dets in zip(chunk, results):
+            dets.xyxy += np.array([x, y, x, y], dtype=np.float32)
+            parts.append(dets)
+    if full_pass:
+        # A downscaled pass over the whole frame still catches objects larger than a tile
+        started = time.perf_counter()
+        parts.append(backend.predict([frame], **params)[0])
+        batch_ms.append((time.perf_counter() - started) * 1000)
+
+    merged = merge_detections(parts, backend.names, (height, width), merge_iou)
+    merged.speed = {"inference": round(sum(batch_ms), 1)}
+    merged.info = {
+        "tiles": len(origins),
+        "tile_batches": len(batch_ms) - int(full_pass),
+        "ms_per_tile": round(sum(batch_ms[:len(batch_ms) - int(full_pass)]) / len(origins), 1),
+        "batch_ms": [round(ms, 1) for ms in batch_ms],
+    }
+    return merged
+
+
+# -------------- Batch Processing ----------------
+EXIF_ORIENTATION = 0x0112
+
+
+def decode_bytes(data):
+    frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if frame is None:
+        raise ValueError("Unsupported or corrupt image")
+    return frame
+
+
+def decode_reduced(data, target=None):
+    # Decodes straight to roughly target pixels on the long side; returns (frame, original (h, w)).
+    # JPEGs use draft mode, so libjpeg's DCT scaling skips most of the full-resolution work.
+    # Both paths apply EXIF orientation, so boxes share one coordinate frame whether or not tiling is on.
+    if not target:
+        frame = decode_bytes(data)
+        return frame, frame.shape[:2]
+    img = Image.open(io.BytesIO(data))
+    width, height = img.size
+    long_side = max(width, height)
+    if img.format == "JPEG" and long_side > target:
+        img.draft("RGB", (math.ceil(width * target / long_side), math.ceil(height * target / long_side)))
+    if img.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+        # Rotated by 90 degrees: the upright image is height x width
+        width, height = height, width
+    frame = pil_to_bgr(ImageOps.exif_transpose(img))
+    if max(frame.shape[:2]) > 2 * target:
+        # Formats without DCT scaling (PNG) are shrunk right after decode instead
+        ratio = target / max(frame.shape[:2])
+        frame = cv2.resize(frame, (round(frame.shape[1] * ratio), round(frame.shape[0] * ratio)),
+                           interpolation=cv2.INTER_AREA)
+    return frame, (height, width)
+
+
+def decode_many(blobs, target=None, workers=4):
+    # Both decoders release the GIL, so threads decode in parallel
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda data: decode_reduced(data, target), blobs))
+
+
+def detection_rows(dets, source):
+    rows = []
+    for (x1, y1, x2, y2), label, p in zip(dets.xyxy.tolist(), dets.labels(), dets.conf.tolist()):
+        rows.append({
+            "image": source,
+            "class": label,
+            "confidence": round(p, 4),
+            "x1": round(x1, 1),
+            "y1": round(y1, 1),
+            "x2": round(x2, 1),
+            "y2": round(y2, 1),
+        })
+    return rows
+
+
+def export_names(filenames):
+    # Uploads may share a basename (a.jpg twice, or a.jpg and a.png); the index keeps every zip member
+    # and every CSV/JSON "image" value unique, and the order matches the upload order
+    width = len(str(len(filenames)))
+    return [f"{i:0{width}d}_{name}" for i, name in enumerate(filenames, 1)]
+
+
+def build_export_zip(annotated, rows):
+    # annotated: {export name: jpeg bytes} with names from export_names(); rows: flat detection records for every image
+    fields = ["image", "class", "confidence", "x1", "y1", "x2", "y2"]
+    csv_buf = io.StringIO()
+    writer = csv.DictWriter(csv_buf, fieldnames=fields)
+    writer.writeheader()
+    writer.writerows(rows)
+
+    buf = io.BytesIO()
+    # JPEGs are already compressed, so store them instead of deflating again
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:
+        for name, data in annotated.items():
+            zf.writestr(f"annotated/{os.path.splitext(name)[0]}.jpg", data)
+        zf.writestr("detections.csv", csv_buf.getvalue(), compress_type=zipfile.ZIP_DEFLATED)
+        zf.writestr("detections.json", json.dumps(rows, indent=2), compress_type=zipfile.ZIP_DEFLATED)
+    return buf.getvalue()
+
+
+# -------------- Result Cache ----------------
+def file_digest(path, chunk_size=1 << 20):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def result_nbytes(dets, annotated=b""):
+    return dets.nbytes + len(annotated)
+
+
+class DetectionCache:
+    # LRU keyed by image content + inference parameters, bounded by an approximate byte budget
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(data, weights_hash, **params):
+        h = hashlib.blake2b(data, digest_size=16)
+        h.update(weights_hash.encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,271 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: writers in one process are still serialized, but only one process may write a directory
+    fcntl = None
+
+# One file per column per segment, opened as .npy memmaps. Rows are only ever appended; a
+# segment's metadata (row count, time range, per-class counts) is rewritten atomically after each
+# flush and doubles as the index, so readers never see a half-written row and skip segments
+# outside the queried time range or without the queried classes. Writers in several processes (the app and
+# multistream.py --store) share a directory through an exclusive lock file and re-read the on-disk state under it.
+COLUMNS = {
+    "time": ("<f8", ()),
+    "source": ("<i4", ()),
+    "cls": ("<i2", ()),
+    "conf": ("<f4", ()),
+    "xyxy": ("<f4", (4,)),
+}
+SEGMENT_ROWS = 1 << 16
+DEFAULT_LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".detection_log")
+
+
+def _write_json(path, data):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+# -------------- Columnar Store ----------------
+class DetectionStore:
+    def __init__(self, root=DEFAULT_LOG_DIR, segment_rows=SEGMENT_ROWS):
+        self.root = root
+        self.segment_rows = segment_rows
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._lock_path = os.path.join(root, ".lock")
+        self._columns = {}
+        self._meta = {}
+        self.refresh()
+
+    def refresh(self):
+        # Picks up rows appended by another process (e.g. multistream.py)
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        # Caller holds _lock. Sealed segments never change, so only new ones and the newest are re-read.
+        self.sources = self._load("sources.json", [])
+        self.names = {int(k): v for k, v in self._load("names.json", {}).items()}
+        self.segments = sorted(name[:-5] for name in os.listdir(self.root)
+                               if name.startswith("segment-") and name.endswith(".json"))
+        for name in self.segments:
+            if name not in self._meta or name == self.segments[-1]:
+                self._meta[name] = self._load(f"{name}.json", None)
+
+    @contextmanager
+    def _exclusive(self):
+        # Serializes writers across threads and processes; the state is re-read once the lock is held
+        with self._lock:
+            if fcntl is None:
+                self._sync()
+                yield
+                return
+            with open(self._lock_path, "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    self._sync()
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load(self, name, default):
+        path = os.path.join(self.root, name)
+        if not os.path.exists(path):
+            return default
+        with open(path) as f:
+            return json.load(f)
+
+    def source_id(self, source):
+        # Ids are never reassigned, so a known source needs no file lock
+        source = str(source)
+        with self._lock:
+            if source in self.sources:
+                return self.sources.index(source)
+        with self._exclusive():
+            if source not in self.sources:
+                self.sources.append(source)
+                _write_json(os.path.join(self.root, "sources.json"), self.sources)
+            return self.sources.index(source)
+
+    def register_names(self, names):
+        with self._lock:
+            if all(self.names.get(k) == v for k, v in names.items()):
+                return
+        with self._exclusive():
+            if any(self.names.get(k) != v for k, v in names.items()):
+                self.names.update(names)
+                _write_json(os.path.join(self.root, "names.json"), {str(k): v for k, v in self.names.items()})
+
+    def _open(self, name, mode="r"):
+        key = (name, mode)
+        if key not in self._columns:
+            columns = {}
+            for column, (dtype, shape) in COLUMNS.items():
+                path = os.path.join(self.root, f"{name}.{column}.npy")
+                if mode == "r+" and not os.path.exists(path):
+                    columns[column] = np.lib.format.open_memmap(path, "w+", dtype, (self.segment_rows, *shape))
+                else:
+                    columns[column] = np.load(path, mmap_mode=mode)
+            self._columns[key] = columns
+        return self._columns[key]
+
+    def _new_segment(self):
+        name = f"segment-{len(self.segments):06d}"
+        self._meta[name] = {"rows": 0, "t_min": None, "t_max": None, "class_counts": {}}
+        self.segments.append(name)
+        return name
+
+    def append(self, columns):
+        # columns: {column: array} with equal lengths; rows go after whatever any writer appended last
+        total = len(columns["time"])
+        with self._exclusive():
+            done = 0
+            while done < total:
+                name = self.segments[-1] if self.segments else self._new_segment()
+                meta = self._meta[name]
+                if meta["rows"] >= self.segment_rows:
+                    name = self._new_segment()
+                    meta = self._meta[name]
+                start = meta["rows"]
+                n = min(total - done, self.segment_rows - start)
+                target = self._open(name, "r+")
+                for column in COLUMNS:
+                    target[column][start:start + n] = columns[column][done:done + n]
+                    target[column].flush()
+                chunk_time = columns["time"][done:done + n]
+                ids, counts = np.unique(columns["cls"][done:done + n], return_counts=True)
+                class_counts = meta["class_counts"]
+                for k, c in zip(ids.tolist(), counts.tolist()):
+                    class_counts[str(k)] = class_counts.get(str(k), 0) + c
+                t_min, t_max = float(chunk_time.min()), float(chunk_time.max())
+                meta["t_min"] = t_min if meta["t_min"] is None else min(meta["t_min"], t_min)
+                meta["t_max"] = t_max if meta["t_max"] is None else max(meta["t_max"], t_max)
+                meta["rows"] = start + n
+                _write_json(os.path.join(self.root, f"{name}.json"), meta)
+                done += n
+
+    # -------------- Queries ----------------
+    def query(self, start=None, end=None, classes=None, sources=None):
+        # Returns {column: array} for rows with start <= time < end; classes and sources are names
+        class_ids = None if classes is None else [k for k, v in self.names.items() if v in set(classes)]
+        source_ids = None if sources is None else [i for i, s in enumerate(self.sources) if s in set(sources)]
+        with self._lock:
+            plan = [(name, dict(self._meta[name])) for name in self.segments]
+        parts = {column: [] for column in COLUMNS}
+        for name, meta in plan:
+            rows = meta["rows"]
+            if not rows:
+                continue
+            if start is not None and meta["t_max"] < start or end is not None and meta["t_min"] >= end:
+                continue
+            if class_ids is not None and not any(str(k) in meta["class_counts"] for k in class_ids):
+                continue
+            data = self._open(name, "r")
+            mask = np.ones(rows, dtype=bool)
+            if start is not None:
+                mask &= data["time"][:rows] >= start
+            if end is not None:
+                mask &= data["time"][:rows] < end
+            if class_ids is not None:
+                mask &= np.isin(data["cls"][:rows], class_ids)
+            if source_ids is not None:
+                mask &= np.isin(data["source"][:rows], source_ids)
+            for column in COLUMNS:
+                parts[column].append(np.asarray(data[column][:rows][mask]))
+        return {
+            column: np.concatenate(arrays) if arrays else np.zeros((0, *COLUMNS[column][1]), COLUMNS[column][0])
+            for column, arrays in parts.items()
+        }
+
+    def counts_per_hour(self, classes, start=None, end=None):
+        # [{"source", "hour" (unix seconds), "count"}] for the given class names, e.g. red lights per camera per hour
+        rows = self.query(start, end, classes)
+        if not len(rows["time"]):
+            return []
+        hours = (rows["time"] // 3600).astype(np.int64)
+        keys, counts = np.unique(np.stack([rows["source"].astype(np.int64), hours], axis=1), axis=0,
+                                 return_counts=True)
+        return [{"source": self.sources[s], "hour": int(h) * 3600, "count": int(c)}
+                for (s, h), c in zip(keys.tolist(), counts.tolist())]
+
+    def stats(self):
+        with self._lock:
+            metas = [self._meta[name] for name in self.segments]
+        times = [m for m in metas if m["rows"]]
+        return {
+            "rows": sum(m["rows"] for m in metas),
+            "segments": len(metas),
+            "sources": len(self.sources),
+            "t_min": min((m["t_min"] for m in times), default=None),
+            "t_max": max((m["t_max"] for m in times), default=None),
+        }
+
+
+# -------------- Buffered Writer ----------------
+class DetectionLogWriter:
+    # write() only copies a few small arrays into a list; a background thread turns the buffer into
+    # one bulk memmap append every flush_interval seconds or flush_rows rows, off the inference path.
+    def __init__(self, store, flush_rows=4096, flush_interval=2.0):
+        self.store = store
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.error = None
+        self._buffer = []
+        self._buffered = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, source, dets, timestamp=None):
+        if not len(dets):
+            return
+        n = len(dets)
+        chunk = {
+            "time": np.full(n, time.time() if timestamp is None else timestamp, dtype=np.float64),
+            "source": np.full(n, self.store.source_id(source), dtype=np.int32),
+            "cls": dets.cls.astype(np.int16),
+            "conf": dets.conf.astype(np.float32),
+            "xyxy": dets.xyxy.astype(np.float32),
+        }
+        self.store.register_names(dets.names)
+        with self._lock:
+            self._buffer.append(chunk)
+            self._buffered += n
+            full = self._buffered >= self.flush_rows
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        with self._lock:
+            chunks, self._buffer, self._buffered = self._buffer, [], 0
+        if chunks:
+            self.store.append({column: np.concatenate([c[column] for c in chunks]) for column in COLUMNS})
+            self.written += sum(len(c["time"]) for c in chunks)
+
+    def _run(self):
+        while self._running:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self.error = str(e)
+
+    def close(self):
+        self._running = False
+        self._wake.set()
+        self._thread.join(timeout=5)
+        self.flush()
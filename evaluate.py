@@ -0,0 +1,289 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from backends import BACKENDS, load_backend
+from detection import file_digest
+from tracking import iou_matrix
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".eval_cache")
+CACHE_VERSION = 2
+
+
+# -------------- Dataset ----------------
+def list_images(images_dir):
+    return sorted(os.path.join(images_dir, name) for name in os.listdir(images_dir)
+                  if name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def label_path(image_path):
+    # YOLO layout: .../images/x.jpg -> .../labels/x.txt
+    head, name = os.path.split(image_path)
+    parent, folder = os.path.split(head)
+    labels_dir = os.path.join(parent, "labels" if folder == "images" else folder)
+    return os.path.join(labels_dir, os.path.splitext(name)[0] + ".txt")
+
+
+def load_labels(image_path, shape):
+    # (n, 5) [cls, x1, y1, x2, y2] in pixels from normalized "cls cx cy w h" lines
+    path = label_path(image_path)
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return np.zeros((0, 5), dtype=np.float32)
+    rows = np.loadtxt(path, dtype=np.float32, ndmin=2)[:, :5]
+    h, w = shape
+    cx, cy, bw, bh = rows[:, 1] * w, rows[:, 2] * h, rows[:, 3] * w, rows[:, 4] * h
+    return np.stack([rows[:, 0], cx - bw / 2, cy - bh / 2, cx + bw / 2, cy + bh / 2], axis=1).astype(np.float32)
+
+
+def load_sample(path):
+    # cv2.imread releases the GIL, so a thread pool decodes in parallel with inference
+    frame = cv2.imread(path)
+    if frame is None:
+        raise ValueError(f"Could not read image: {path}")
+    return frame, load_labels(path, frame.shape[:2])
+
+
+def prefetch(paths, batch_size, workers):
+    # Yields (paths, frames, labels) batches; the next batch is decoding while the current one runs
+    with ThreadPoolExecutor(workers) as pool:
+        chunks = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+        pending = [pool.submit(load_sample, p) for p in chunks[0]] if chunks else []
+        for index, chunk in enumerate(chunks):
+            current = pending
+            pending = [pool.submit(load_sample, p) for p in chunks[index + 1]] if index + 1 < len(chunks) else []
+            samples = [future.result() for future in current]
+            yield chunk, [frame for frame, _ in samples], [labels for _, labels in samples]
+
+
+def dataset_digest(paths):
+    # Paths, sizes and mtimes: cheap to compute and changes whenever an image or label changes
+    h = hashlib.blake2b(digest_size=8)
+    for path in paths:
+        for p in (path, label_path(path)):
+            if os.path.exists(p):
+                stat = os.stat(p)
+                h.update(f"{p}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return h.hexdigest()
+
+
+# -------------- Prediction Cache ----------------
+def anchor_count(imgsz):
+    # YOLOv8 predicts one box per cell of its stride 8, 16 and 32 grids: 8400 at 640
+    imgsz = max(32, int(imgsz) // 32 * 32)
+    return sum((imgsz // stride) ** 2 for stride in (8, 16, 32))
+
+
+class PredictionCache:
+    # Candidate boxes from one low-threshold, NMS-free model pass, memory-mapped from disk:
+    # preds.f32 rows are [x1, y1, x2, y2, conf, cls], gt.f32 rows [cls, x1, y1, x2, y2], and the
+    # offsets files give each image's slice. Every threshold sweep reads this instead of the model.
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.preds = np.memmap(os.path.join(path, "preds.f32"), dtype=np.float32, mode="r").reshape(-1, 6)
+        self.gt = np.memmap(os.path.join(path, "gt.f32"), dtype=np.float32, mode="r").reshape(-1, 5)
+        self.pred_offsets = np.load(os.path.join(path, "pred_offsets.npy"))
+        self.gt_offsets = np.load(os.path.join(path, "gt_offsets.npy"))
+
+    def __len__(self):
+        return len(self.pred_offsets) - 1
+
+    def image(self, i):
+        return (self.preds[self.pred_offsets[i]:self.pred_offsets[i + 1]],
+                self.gt[self.gt_offsets[i]:self.gt_offsets[i + 1]])
+
+    @staticmethod
+    def build(path, backend, paths, batch_size=8, workers=8, floor_conf=0.001, imgsz=640, meta=None):
+        # iou=1.0 makes NMS a no-op and max_det=anchors lifts the top-k cap, so the cache holds every
+        # candidate above floor_conf; the model's own post-NMS max_det is applied per sweep in nms()
+        max_det = anchor_count(imgsz)
+        work = f"{path}.partial"
+        shutil.rmtree(work, ignore_errors=True)
+        os.makedirs(work)
+        pred_offsets, gt_offsets = [0], [0]
+        started = time.perf_counter()
+        with open(os.path.join(work, "preds.f32"), "wb") as preds_file, \
+                open(os.path.join(work, "gt.f32"), "wb") as gt_file:
+            for chunk, frames, labels in prefetch(paths, batch_size, workers):
+                detections = backend.predict(frames, batch_size=len(frames), conf=floor_conf, iou=1.0,
+                                             imgsz=imgsz, max_det=max_det)
+                for dets, gt in zip(detections, labels):
+                    rows = np.concatenate([dets.xyxy, dets.conf[:, None], dets.cls[:, None]], axis=1)
+                    preds_file.write(rows.astype(np.float32).tobytes())
+                    gt_file.write(gt.astype(np.float32).tobytes())
+                    pred_offsets.append(pred_offsets[-1] + len(rows))
+                    gt_offsets.append(gt_offsets[-1] + len(gt))
+                done = len(pred_offsets) - 1
+                print(f"\rPredicted {done}/{len(paths)} images "
+                      f"({done / (time.perf_counter() - started):.1f} img/s)", end="", file=sys.stderr)
+        print(file=sys.stderr)
+        np.save(os.path.join(work, "pred_offsets.npy"), np.asarray(pred_offsets, dtype=np.int64))
+        np.save(os.path.join(work, "gt_offsets.npy"), np.asarray(gt_offsets, dtype=np.int64))
+        with open(os.path.join(work, "meta.json"), "w") as f:
+            json.dump({**(meta or {}), "images": paths, "floor_conf": floor_conf, "max_det": max_det,
+                       "predict_s": round(time.perf_counter() - started, 2)}, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(work, path)
+        return PredictionCache(path)
+
+
+# -------------- Metrics ----------------
+def nms(preds, conf, iou, max_det=300):
+    # Class-aware NMS over cached candidates, as the model would have run it at these thresholds,
+    # keeping the max_det highest-scoring survivors
+    preds = preds[preds[:, 4] >= conf]
+    if not len(preds):
+        return preds
+    if iou >= 1.0:
+        return preds[np.argsort(-preds[:, 4], kind="stable")[:max_det]]
+    xywh = np.concatenate([preds[:, :2], preds[:, 2:4] - preds[:, :2]], axis=1)
+    keep = cv2.dnn.NMSBoxesBatched(xywh.tolist(), preds[:, 4].tolist(), preds[:, 5].astype(int).tolist(),
+                                   conf, iou)
+    return preds[np.asarray(keep, dtype=int).reshape(-1)[:max_det]]
+
+
+def match(preds, gt):
+    # (n_preds, 10) true-positive flags at IoU 0.50:0.95, greedy by IoU with one prediction per label
+    tp = np.zeros((len(preds), len(IOU_THRESHOLDS)), dtype=bool)
+    if not len(preds) or not len(gt):
+        return tp
+    ious = iou_matrix(gt[:, 1:], preds[:, :4]) * (gt[:, :1] == preds[None, :, 5])
+    for t, threshold in enumerate(IOU_THRESHOLDS):
+        gi, pi = np.nonzero(ious >= threshold)
+        if not len(gi):
+            continue
+        order = np.argsort(-ious[gi, pi], kind="stable")
+        gi, pi = gi[order], pi[order]
+        _, first_pred = np.unique(pi, return_index=True)
+        gi, pi = gi[first_pred], pi[first_pred]
+        order = np.argsort(-ious[gi, pi], kind="stable")
+        gi, pi = gi[order], pi[order]
+        _, first_gt = np.unique(gi, return_index=True)
+        tp[pi[first_gt], t] = True
+    return tp
+
+
+def average_precision(recall, precision):
+    # COCO-style 101-point interpolated AP
+    mrec = np.concatenate(([0.0], recall, [1.0]))
+    mpre = np.flip(np.maximum.accumulate(np.flip(np.concatenate(([1.0], precision, [0.0])))))
+    x = np.linspace(0, 1, 101)
+    y = np.interp(x, mrec, mpre)
+    return float(np.sum((x[1:] - x[:-1]) * (y[1:] + y[:-1]) / 2))
+
+
+def score(cache, conf, iou, names, max_det=300):
+    tps, confs, classes, gt_classes = [], [], [], []
+    for i in range(len(cache)):
+        preds, gt = cache.image(i)
+        kept = nms(np.asarray(preds), conf, iou, max_det)
+        tps.append(match(kept, np.asarray(gt)))
+        confs.append(kept[:, 4])
+        classes.append(kept[:, 5])
+        gt_classes.append(np.asarray(gt[:, 0]))
+    tp = np.concatenate(tps) if tps else np.zeros((0, len(IOU_THRESHOLDS)), dtype=bool)
+    conf_all = np.concatenate(confs) if confs else np.zeros(0)
+    cls_all = np.concatenate(classes) if classes else np.zeros(0)
+    gt_all = np.concatenate(gt_classes) if gt_classes else np.zeros(0)
+
+    order = np.argsort(-conf_all, kind="stable")
+    tp, cls_all = tp[order], cls_all[order]
+    per_class = {}
+    for c in np.unique(gt_all).astype(int):
+        n_gt = int((gt_all == c).sum())
+        hits = tp[cls_all == c]
+        true_pos = hits.cumsum(0)
+        false_pos = (~hits).cumsum(0)
+        recall = true_pos / n_gt
+        precision = true_pos / np.maximum(true_pos + false_pos, 1)
+        ap = [average_precision(recall[:, t], precision[:, t]) if len(hits) else 0.0
+              for t in range(len(IOU_THRESHOLDS))]
+        n_pred = len(hits)
+        per_class[names.get(c, str(c))] = {
+            "labels": n_gt,
+            "precision": round(float(true_pos[-1, 0] / n_pred), 4) if n_pred else 0.0,
+            "recall": round(float(true_pos[-1, 0] / n_gt), 4) if n_pred else 0.0,
+            "mAP50": round(ap[0], 4),
+            "mAP50-95": round(float(np.mean(ap)), 4),
+        }
+    result = {"conf": conf, "iou": iou, "max_det": max_det, "classes": per_class}
+    for key in ("precision", "recall", "mAP50", "mAP50-95"):
+        values = [c[key] for c in per_class.values()]
+        result[key] = round(float(np.mean(values)), 4) if values else 0.0
+    p, r = result["precision"], result["recall"]
+    result["f1"] = round(2 * p * r / (p + r), 4) if p + r else 0.0
+    return result
+
+
+def parse_grid(value):
+    return [float(v) for v in value.split(",") if v]
+
+
+# -------------- CLI ----------------
+def main():
+    parser = argparse.ArgumentParser(
+        description="Evaluate the model on a YOLO-format dataset once, then sweep conf/iou from cached predictions")
+    parser.add_argument("images", help="Directory of images; labels are read from the sibling labels/ directory")
+    parser.add_argument("--weights", default="best.pt")
+    parser.add_argument("--backend", default="pytorch", choices=BACKENDS)
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=8, help="Image loading threads")
+    parser.add_argument("--conf-grid", default="0.001,0.05,0.1,0.15,0.2,0.25,0.3,0.4,0.5,0.6,0.7")
+    parser.add_argument("--iou-grid", default="0.45,0.5,0.6,0.7,0.8")
+    parser.add_argument("--max-det", type=int, default=300, help="Boxes kept per image after NMS, as in the app")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--refresh", action="store_true", help="Re-run the model even if cached predictions exist")
+    parser.add_argument("--output", default="evaluation_results.json")
+    args = parser.parse_args()
+
+    paths = list_images(args.images)
+    if not paths:
+        parser.error(f"No images found in {args.images}")
+    key = f"v{CACHE_VERSION}-{file_digest(args.weights)}-{args.backend}-{args.imgsz}-{dataset_digest(paths)}"
+    cache_path = os.path.join(args.cache_dir, key)
+
+    if args.refresh or not os.path.exists(os.path.join(cache_path, "meta.json")):
+        backend = load_backend(args.weights, args.backend)
+        backend.warmup(args.imgsz)
+        names = {str(k): v for k, v in backend.names.items()}
+        cache = PredictionCache.build(cache_path, backend, paths, args.batch_size, args.workers,
+                                      imgsz=args.imgsz, meta={"names": names, "weights": args.weights})
+        print(f"Cached raw predictions for {len(cache)} images in {cache.meta['predict_s']}s -> {cache_path}")
+    else:
+        cache = PredictionCache(cache_path)
+        print(f"Using cached predictions for {len(cache)} images from {cache_path}")
+    names = {int(k): v for k, v in cache.meta["names"].items()}
+
+    started = time.perf_counter()
+    results = []
+    for iou in parse_grid(args.iou_grid):
+        for conf in parse_grid(args.conf_grid):
+            result = score(cache, conf, iou, names, args.max_det)
+            results.append(result)
+            print(f"conf={conf:<6} iou={iou:<5} P={result['precision']:.3f} R={result['recall']:.3f} "
+                  f"F1={result['f1']:.3f} mAP50={result['mAP50']:.3f} mAP50-95={result['mAP50-95']:.3f}")
+    sweep_seconds = time.perf_counter() - started
+    best = max(results, key=lambda r: r["f1"])
+    print(f"Swept {len(results)} settings in {sweep_seconds:.1f}s; best F1 {best['f1']:.3f} "
+          f"at conf={best['conf']} iou={best['iou']}")
+
+    with open(args.output, "w") as f:
+        json.dump({"images": len(cache), "cache": cache_path, "predict_s": cache.meta["predict_s"],
+                   "sweep_s": round(sweep_seconds, 2), "best_f1": best, "results": results}, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
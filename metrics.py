@@ -0,0 +1,192 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger("traffic_ai.metrics")
+
+
+# -------------- Metric Registry ----------------
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Metrics:
+    # Process-wide counters, gauges and histograms with Prometheus text and JSON export
+    def __init__(self, prefix="traffic_ai"):
+        self.prefix = prefix
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    def set_gauge(self, name, value, **labels):
+        # value may be a callable, evaluated at export time (e.g. a live queue depth)
+        with self._lock:
+            self._gauges[(name, _label_key(labels))] = value
+
+    def set_gauge_once(self, name, value, **labels):
+        with self._lock:
+            self._gauges.setdefault((name, _label_key(labels)), value)
+
+    def gauges(self, name):
+        # {label value: gauge value} for a single-label gauge family, for display
+        with self._lock:
+            items = [(key, value) for (n, key), value in self._gauges.items() if n == name]
+        return {",".join(str(v) for _, v in key): (value() if callable(value) else value) for key, value in items}
+
+    def render_prometheus(self):
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {key: (h.buckets, list(h.counts), h.sum, h.count) for key, h in self._histograms.items()}
+        for kind, items in (("counter", counters), ("gauge", gauges)):
+            seen = set()
+            for (name, key), value in sorted(items.items(), key=lambda kv: kv[0]):
+                full = f"{self.prefix}_{name}"
+                if full not in seen:
+                    lines.append(f"# TYPE {full} {kind}")
+                    seen.add(full)
+                value = value() if callable(value) else value
+                lines.append(f"{full}{_format_labels(key)} {value}")
+        seen = set()
+        for (name, key), (buckets, counts, total, count) in sorted(histograms.items(), key=lambda kv: kv[0]):
+            full = f"{self.prefix}_{name}"
+            if full not in seen:
+                lines.append(f"# TYPE {full} histogram")
+                seen.add(full)
+            cumulative = 0
+            for bound, n in zip(buckets, counts):
+                cumulative += n
+                lines.append(f"{full}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{full}_bucket{_format_labels(key, [('le', '+Inf')])} {count}")
+            lines.append(f"{full}_sum{_format_labels(key)} {total:.6f}")
+            lines.append(f"{full}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        def flat(name, key):
+            return name + "".join(f"[{k}={v}]" for k, v in key)
+
+        with self._lock:
+            return {
+                "counters": {flat(*k): v for k, v in self._counters.items()},
+                "gauges": {flat(*k): (v() if callable(v) else v) for k, v in self._gauges.items()},
+                "histograms": {
+                    flat(*k): {"count": h.count, "sum": round(h.sum, 6),
+                               "mean": round(h.sum / h.count, 6) if h.count else 0.0}
+                    for k, h in self._histograms.items()
+                },
+            }
+
+
+# -------------- Per-request Timing ----------------
+class RequestTimer:
+    # Collects stage timings for one request and feeds them into the shared registry
+    def __init__(self, metrics, source):
+        self.metrics = metrics
+        self.source = source
+        self.stages = {}
+        self.info = {}
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed * 1000
+            self.metrics.observe("stage_seconds", elapsed, source=self.source, stage=name)
+
+    def finish(self, **info):
+        total = time.perf_counter() - self._started
+        self.info.update(info)
+        self.metrics.inc("requests_total", source=self.source)
+        self.metrics.set_gauge_once("first_request_seconds", total, source=self.source)
+        self.metrics.observe("request_seconds", total, source=self.source)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps({
+                "event": "request",
+                "source": self.source,
+                "total_ms": round(total * 1000, 3),
+                "stages_ms": {k: round(v, 3) for k, v in self.stages.items()},
+                **self.info,
+            }))
+        return total * 1000
+
+
+def configure_json_logging(level=logging.INFO):
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+# -------------- Prometheus Endpoint ----------------
+def start_metrics_server(metrics, port, host="127.0.0.1"):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith("/metrics.json"):
+                body, content_type = json.dumps(metrics.snapshot()).encode(), "application/json"
+            elif self.path.startswith("/metrics"):
+                body, content_type = metrics.render_prometheus().encode(), "text/plain; version=0.0.4"
+            else:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,275 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+import numpy as np
+
+from backends import BACKENDS, load_backend
+from detection import detection_rows
+from detection_log import DetectionLogWriter, DetectionStore
+from streams import FrameGrabber
+
+
+# -------------- Worker Processes ----------------
+# Each pool process loads the model once in its initializer and keeps it for its lifetime
+_worker = {}
+
+
+def _init_worker(weights, backend, threads, imgsz):
+    # One OpenCV thread and a slice of the cores per worker, so N workers do not oversubscribe the CPU
+    cv2.setNumThreads(1)
+    _worker["backend"] = load_backend(weights, backend, threads)
+    _worker["backend"].warmup(imgsz)
+
+
+def _detect(frame, params):
+    started = time.perf_counter()
+    dets = _worker["backend"].predict([frame], **params)[0]
+    return dets, (time.perf_counter() - started) * 1000, os.getpid()
+
+
+def shrink(frame, size):
+    # The model letterboxes to imgsz anyway; resizing first keeps the pickled frame small
+    h, w = frame.shape[:2]
+    scale = size / max(h, w)
+    if scale >= 1:
+        return frame
+    return cv2.resize(frame, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+
+
+# -------------- Scheduler ----------------
+class StreamState:
+    def __init__(self, index, source, fps):
+        self.index = index
+        self.source = source
+        self.grabber = FrameGrabber(source)
+        self.interval = 1.0 / fps
+        self.next_due = 0.0
+        self.in_flight = False
+        self.last_frame_id = 0
+        self.analyzed = 0
+        self.detections = 0
+        self.errors = 0
+        self.error = None
+        self.latency_ms = deque(maxlen=1000)
+        self.infer_ms = deque(maxlen=1000)
+
+
+class MultiStreamRunner:
+    # Fans frames from many sources out to a process pool. Every stream gets at most `fps` frames per
+    # second and at most one frame in flight, and streams are served round-robin, so a busy or
+    # high-rate source cannot starve the others; each stream always analyzes its newest frame.
+    def __init__(self, sources, weights="best.pt", backend="pytorch", workers=None, fps=5, max_in_flight=None,
+                 **params):
+        cores = os.cpu_count() or 1
+        self.workers = workers or cores
+        self.params = params
+        self.imgsz = params.get("imgsz", 640)
+        self.max_in_flight = max_in_flight or 2 * self.workers
+        self.streams = [StreamState(i, source, fps) for i, source in enumerate(sources)]
+        self.worker_frames = {}
+        self._next = 0
+        self._started = None
+        self._stopped = False
+        self.pool_restarts = 0
+        self._initargs = (weights, backend, max(1, cores // self.workers), self.imgsz)
+        self._healthy = False
+        self.pool = self._new_pool()
+
+    def _new_pool(self):
+        # spawn, not fork: torch and OpenCV thread pools do not survive a fork reliably
+        return ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=self._initargs,
+        )
+
+    def _schedule(self, pending, now):
+        order = [self.streams[(self._next + i) % len(self.streams)] for i in range(len(self.streams))]
+        for stream in order:
+            if len(pending) >= self.max_in_flight:
+                break
+            if stream.in_flight or now < stream.next_due or not stream.grabber.running:
+                continue
+            frame_id, frame = stream.grabber.latest()
+            if frame is None or frame_id == stream.last_frame_id:
+                continue
+            future = self.pool.submit(_detect, shrink(frame, self.imgsz), self.params)
+            pending[future] = (stream, frame_id, frame, now)
+            stream.in_flight = True
+            stream.last_frame_id = frame_id
+            stream.next_due = max(stream.next_due + stream.interval, now)
+            self._next = (stream.index + 1) % len(self.streams)
+
+    def run(self, duration=None, on_result=None):
+        # on_result(stream_index, source, frame_id, frame, dets) is called in this process for every analyzed frame
+        for stream in self.streams:
+            try:
+                stream.grabber.start()
+            except RuntimeError as e:
+                # One dead camera should not take the other streams down
+                stream.grabber.error = str(e)
+        self._started = time.perf_counter()
+        pending = {}
+        try:
+            while not self._stopped:
+                now = time.perf_counter()
+                if duration is not None and now - self._started >= duration:
+                    break
+                if not pending and not any(s.grabber.running for s in self.streams):
+                    break
+                self._schedule(pending, now)
+                due = [s.next_due for s in self.streams if not s.in_flight]
+                timeout = max(0.001, min(due) - time.perf_counter()) if due else 0.05
+                if not pending:
+                    time.sleep(min(timeout, 0.05))
+                    continue
+                done, _ = wait(list(pending), timeout=min(timeout, 0.05), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stream, frame_id, frame, submitted = pending.pop(future)
+                    stream.in_flight = False
+                    try:
+                        dets, infer_ms, pid = future.result()
+                    except BrokenProcessPool:
+                        # A worker died (e.g. out of memory); every pending frame is lost, so start a new pool
+                        self._fail(stream, "worker process died")
+                        self._restart_pool(pending)
+                        break
+                    except Exception as e:
+                        # One bad frame or backend error only costs this stream this frame
+                        self._fail(stream, str(e))
+                        continue
+                    self._healthy = True
+                    dets = dets.rescaled(frame.shape[:2])
+                    stream.analyzed += 1
+                    stream.detections += len(dets)
+                    stream.latency_ms.append((time.perf_counter() - submitted) * 1000)
+                    stream.infer_ms.append(infer_ms)
+                    self.worker_frames[pid] = self.worker_frames.get(pid, 0) + 1
+                    if on_result is not None:
+                        on_result(stream.index, stream.source, frame_id, frame, dets)
+        finally:
+            self.close()
+        return self.stats()
+
+    def _fail(self, stream, error):
+        stream.errors += 1
+        stream.error = error
+
+    def _restart_pool(self, pending):
+        if not self._healthy:
+            # Broke again before analyzing a single frame: the model cannot load, so restarting is pointless
+            raise RuntimeError("Worker processes keep failing; check the weights and backend")
+        self._healthy = False
+        self.pool_restarts += 1
+        for stream, *_ in pending.values():
+            stream.in_flight = False
+            self._fail(stream, "worker process died")
+        pending.clear()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.pool = self._new_pool()
+
+    def stop(self):
+        self._stopped = True
+
+    def close(self):
+        for stream in self.streams:
+            stream.grabber.stop()
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self):
+        elapsed = time.perf_counter() - self._started if self._started else 0.0
+        streams = []
+        for stream in self.streams:
+            latency = np.asarray(stream.latency_ms or [0.0])
+            streams.append({
+                "source": str(stream.source),
+                "analyzed": stream.analyzed,
+                "fps": round(stream.analyzed / elapsed, 2) if elapsed else 0.0,
+                "dropped": stream.grabber.dropped,
+                "reconnects": stream.grabber.reconnects,
+                "detections": stream.detections,
+                "latency_p50_ms": round(float(np.percentile(latency, 50)), 1),
+                "latency_p95_ms": round(float(np.percentile(latency, 95)), 1),
+                "infer_mean_ms": round(float(np.mean(stream.infer_ms or [0.0])), 1),
+                "errors": stream.errors,
+                "error": stream.grabber.error or stream.error,
+            })
+        total = sum(s["analyzed"] for s in streams)
+        return {
+            "elapsed_s": round(elapsed, 2),
+            "workers": self.workers,
+            "pool_restarts": self.pool_restarts,
+            "aggregate_fps": round(total / elapsed, 2) if elapsed else 0.0,
+            "frames_per_worker": sorted(self.worker_frames.values(), reverse=True),
+            "streams": streams,
+        }
+
+
+# -------------- CLI ----------------
+def main():
+    parser = argparse.ArgumentParser(description="Run detection over many camera streams with a worker pool")
+    parser.add_argument("sources", nargs="+",
+                        help="Video files, image directories, RTSP/HTTP URLs, device indexes or 'synthetic'")
+    parser.add_argument("--weights", default="best.pt")
+    parser.add_argument("--backend", default="pytorch", choices=BACKENDS)
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: one per core)")
+    parser.add_argument("--fps", type=float, default=5, help="Per-stream frame budget")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to run; files loop until then")
+    parser.add_argument("--conf", type=float, default=0.25)
+    parser.add_argument("--iou", type=float, default=0.7)
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--log", help="CSV file for every detection")
+    parser.add_argument("--output", help="JSON file for the run statistics")
+    parser.add_argument("--store", help="Detection log directory to append every detection to (see detection_log.py)")
+    args = parser.parse_args()
+
+    runner = MultiStreamRunner(args.sources, args.weights, args.backend, args.workers, args.fps,
+                               conf=args.conf, iou=args.iou, imgsz=args.imgsz)
+    log_file = open(args.log, "w", newline="") if args.log else None
+    log = None
+    if log_file is not None:
+        log = csv.writer(log_file)
+        log.writerow(["time", "stream", "source", "frame", "class", "confidence", "x1", "y1", "x2", "y2"])
+    store = DetectionLogWriter(DetectionStore(args.store)) if args.store else None
+
+    def on_result(index, source, frame_id, frame, dets):
+        now = time.time()
+        if store is not None:
+            store.write(source, dets, now)
+        if log is not None:
+            for row in detection_rows(dets, source):
+                log.writerow([round(now, 3), index, source, frame_id, row["class"], row["confidence"],
+                              row["x1"], row["y1"], row["x2"], row["y2"]])
+
+    try:
+        stats = runner.run(args.duration, on_result)
+    except KeyboardInterrupt:
+        stats = runner.stats()
+    finally:
+        if log_file is not None:
+            log_file.close()
+        if store is not None:
+            store.close()
+
+    for stream in stats["streams"]:
+        print(f"{stream['source']:>40} {stream['fps']:6.2f} fps  p50={stream['latency_p50_ms']:7.1f}ms "
+              f"p95={stream['latency_p95_ms']:7.1f}ms  dropped={stream['dropped']}"
+              + (f"  error={stream['error']}" if stream["error"] else ""))
+    print(f"Aggregate: {stats['aggregate_fps']} fps over {len(stats['streams'])} streams "
+          f"with {stats['workers']} workers")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(stats, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from backends import load_backend
+from detection import file_digest
+
+DEFAULT_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+
+
+# -------------- Versions ----------------
+class ModelVersion:
+    # One weights file plus its loaded backend and request stats; the stats outlive the backend,
+    # so a retired version can still be compared against the one that replaced it
+    def __init__(self, version, path, window=500):
+        self.version = version
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        self.digest = file_digest(path)
+        self.backend = None
+        self.loaded_at = None
+        self.warmed = set()
+        self.warmup_seconds = None
+        self.in_flight = 0
+        self.requests = 0
+        self.frames = 0
+        self.errors = 0
+        self.ms_per_frame = deque(maxlen=window)
+
+    def stats(self):
+        samples = list(self.ms_per_frame)
+        return {
+            "version": self.version,
+            "loaded": self.backend is not None,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "frames": self.frames,
+            "errors": self.errors,
+            "p50_ms_per_frame": round(float(np.percentile(samples, 50)), 1) if samples else None,
+            "p90_ms_per_frame": round(float(np.percentile(samples, 90)), 1) if samples else None,
+        }
+
+
+# -------------- Registry ----------------
+class ModelRegistry:
+    # Serves predict() from the active version of a directory of weight files (models/v1.pt, models/v2.pt, ...).
+    # A watcher thread loads and warms up new files off the request path, then swaps them in with one
+    # pointer assignment: requests already running keep the backend they started with, and the old
+    # backend is only dropped once its last in-flight call returns. An optional candidate version gets
+    # a share of the traffic, with per-version latency kept side by side for A/B comparison.
+    def __init__(self, root=DEFAULT_MODEL_DIR, backend="pytorch", fallback="best.pt", threads=None, imgsz=640,
+                 poll_interval=5.0, settle=2.0, metrics=None):
+        self.root = root
+        self.backend_name = backend
+        self.fallback = fallback
+        self.threads = threads
+        self.imgsz = imgsz
+        self.settle = settle
+        self.metrics = metrics
+        self.versions = {}
+        self.active = None
+        self.candidate = None
+        self.split = 0.0
+        self.pinned = False
+        self.error = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._running = True
+        available = self.scan()
+        if not available:
+            raise FileNotFoundError(f"No weights found in '{root}' and no '{fallback}' fallback")
+        self.activate(next(reversed(available)), pin=False)
+        self._thread = None
+        if poll_interval:
+            self._wake = threading.Event()
+            self._thread = threading.Thread(target=self._watch, args=(poll_interval,), daemon=True)
+            self._thread.start()
+
+    def scan(self):
+        # {version: path}, oldest first; files modified in the last `settle` seconds may still be
+        # mid-copy and are picked up on a later poll
+        now = time.time()
+        found = []
+        if os.path.isdir(self.root):
+            for name in os.listdir(self.root):
+                path = os.path.join(self.root, name)
+                if name.endswith(".pt") and os.path.isfile(path) and now - os.path.getmtime(path) >= self.settle:
+                    found.append((os.path.getmtime(path), os.path.splitext(name)[0], path))
+        if not found and self.fallback and os.path.exists(self.fallback):
+            found.append((os.path.getmtime(self.fallback), os.path.splitext(os.path.basename(self.fallback))[0],
+                          self.fallback))
+        return {version: path for _, version, path in sorted(found)}
+
+    def load(self, version, path=None):
+        # Loading and warm-up happen outside the request lock, so predict() keeps serving meanwhile
+        with self._load_lock:
+            entry = self.versions.get(version)
+            if path is None:
+                path = entry.path if entry is not None else self.scan()[version]
+            if entry is not None and entry.mtime != os.path.getmtime(path):
+                if entry.digest != file_digest(path):
+                    # Same name, new contents: start a fresh entry rather than mixing stats
+                    entry = None
+                else:
+                    entry.mtime = os.path.getmtime(path)
+            if entry is not None and entry.backend is not None:
+                return entry
+            entry = entry or ModelVersion(version, path)
+            started = time.perf_counter()
+            backend = load_backend(path, self.backend_name, self.threads)
+            loaded = time.perf_counter()
+            backend.warmup(self.imgsz)
+            entry.warmup_seconds = time.perf_counter() - loaded
+            entry.warmed = {self.imgsz}
+            if self.metrics is not None:
+                self.metrics.set_gauge("model_load_seconds", loaded - started, version=version)
+                self.metrics.set_gauge("model_warmup_seconds", entry.warmup_seconds, version=version)
+            entry.loaded_at = time.time()
+            with self._lock:
+                entry.backend = backend
+                self.versions[version] = entry
+            return entry
+
+    def activate(self, version, pin=True):
+        # pin=True is a manual choice (e.g. a rollback): new files are then no longer promoted automatically
+        entry = self.load(version)
+        with self._lock:
+            previous, self.active = self.active, entry
+            self.pinned = pin
+            if self.candidate is entry:
+                self.candidate, self.split = None, 0.0
+            self._release(previous)
+        return entry
+
+    def set_candidate(self, version=None, split=0.0):
+        # Sends `split` (0-1) of the requests to `version`; None stops the comparison
+        entry = self.load(version) if version is not None else None
+        with self._lock:
+            previous = self.candidate
+            if entry is self.active:
+                entry = None
+            self.candidate, self.split = entry, split if entry is not None else 0.0
+            self._release(previous)
+
+    def follow(self, enabled=True):
+        # Back to serving the newest file after a manual pin
+        self.pinned = not enabled
+        if enabled:
+            self.refresh()
+
+    def _release(self, entry):
+        # Caller holds _lock
+        if entry is None or entry is self.active or entry is self.candidate:
+            return
+        if entry.in_flight == 0:
+            entry.backend = None
+
+    def refresh(self):
+        available = self.scan()
+        if not available or self.pinned:
+            return
+        version, path = next(reversed(available.items()))
+        # An unchanged directory costs a stat per file; the file is only hashed once its mtime moves
+        current = self.active
+        if version != current.version or os.path.getmtime(path) != current.mtime:
+            self.activate(version, pin=False)
+
+    def _watch(self, poll_interval):
+        while self._running:
+            self._wake.wait(poll_interval)
+            if not self._running:
+                break
+            try:
+                self.refresh()
+                self.error = None
+            except Exception as e:
+                # A broken upload must not take down the version that is serving
+                self.error = str(e)
+
+    def close(self):
+        self._running = False
+        if self._thread is not None:
+            self._wake.set()
+            self._thread.join(timeout=5)
+
+    # -------------- Backend Contract ----------------
+    @property
+    def names(self):
+        return self.active.backend.names
+
+    @property
+    def weights_hash(self):
+        # Result caches key on this, so it changes with the active version and with the A/B setup
+        with self._lock:
+            active, candidate, split = self.active, self.candidate, self.split
+        if candidate is None:
+            return active.backend.weights_hash
+        return f"{active.backend.weights_hash}+{candidate.backend.weights_hash}@{split}"
+
+    def warmup(self, imgsz=640):
+        # load() already warmed every version at self.imgsz; only other sizes cost a dummy inference
+        with self._lock:
+            entries = [e for e in (self.active, self.candidate) if e is not None and imgsz not in e.warmed]
+        for entry in entries:
+            entry.backend.warmup(imgsz)
+            entry.warmed.add(imgsz)
+
+    def predict(self, frames, batch_size=8, **params):
+        with self._lock:
+            entry = self.active
+            if self.candidate is not None and random.random() < self.split:
+                entry = self.candidate
+            entry.in_flight += 1
+            backend = entry.backend
+        started = time.perf_counter()
+        try:
+            detections = backend.predict(frames, batch_size=batch_size, **params)
+        except Exception:
+            with self._lock:
+                entry.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                entry.in_flight -= 1
+                self._release(entry)
+        with self._lock:
+            entry.requests += 1
+            entry.frames += len(frames)
+            entry.ms_per_frame.append(elapsed * 1000 / max(1, len(frames)))
+        if self.metrics is not None:
+            self.metrics.observe("model_predict_seconds", elapsed, version=entry.version)
+        for dets in detections:
+            dets.info["model_version"] = entry.version
+        return detections
+
+    def stats(self):
+        with self._lock:
+            rows = []
+            for entry in sorted(self.versions.values(), key=lambda e: e.loaded_at or 0):
+                row = entry.stats()
+                row["role"] = ("active" if entry is self.active
+                               else f"candidate ({self.split:.0%})" if entry is self.candidate else "")
+                rows.append(row)
+            return rows
@@ -0,0 +1,212 @@
+import argparse
+import json
+import queue
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from backends import BACKENDS, load_backend
+from metrics import Metrics
+
+
+# -------------- Micro-batching Queue ----------------
+class QueueFull(RuntimeError):
+    pass
+
+
+class MicroBatcher:
+    # Collects concurrent requests into one forward pass: waits at most max_wait_ms
+    # after the first request for up to max_batch_size requests with the same parameters
+    def __init__(self, backend, max_batch_size=16, max_wait_ms=10, max_queue=64, metrics=None):
+        self.backend = backend
+        self.metrics = metrics or Metrics()
+        self.metrics.set_gauge("queue_depth", lambda: self._queue.qsize())
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = 0
+        self.batches = 0
+        self.rejected = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._held = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, frame, params):
+        future = Future()
+        try:
+            self._queue.put_nowait((frame, params, future))
+        except queue.Full:
+            self.rejected += 1
+            self.metrics.inc("rejected_total")
+            raise QueueFull("Inference queue is full")
+        return future
+
+    def _next(self, timeout=None):
+        if self._held is not None:
+            item, self._held = self._held, None
+            return item
+        return self._queue.get(timeout=timeout)
+
+    def _collect(self):
+        batch = [self._next()]
+        key = batch[0][1]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self._next(timeout=remaining)
+            except queue.Empty:
+                break
+            if item[1] != key:
+                # Different conf/iou/imgsz cannot share a forward pass; it opens the next batch
+                self._held = item
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            frames = [frame for frame, _, _ in batch]
+            started = time.perf_counter()
+            try:
+                detections = self.backend.predict(frames, batch_size=len(frames), **dict(batch[0][1]))
+            except Exception as e:
+                self.metrics.inc("errors_total")
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.metrics.observe("stage_seconds", time.perf_counter() - started, source="server", stage="infer")
+            self.metrics.observe("batch_size", len(batch))
+            self.metrics.inc("batches_total")
+            self.requests += len(batch)
+            self.batches += 1
+            for (_, _, future), dets in zip(batch, detections):
+                future.set_result(dets)
+
+    def stats(self):
+        return {
+            "queue_depth": self._queue.qsize(),
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "rejected": self.rejected,
+        }
+
+
+# -------------- HTTP Service ----------------
+def parse_params(query):
+    params = {}
+    if "conf" in query:
+        params["conf"] = float(query["conf"])
+    if "iou" in query:
+        params["iou"] = float(query["iou"])
+    if "imgsz" in query:
+        params["imgsz"] = int(query["imgsz"])
+    return tuple(sorted(params.items()))
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    batcher = None
+    info = None
+    timeout_s = 60
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        if path == "/info":
+            self._send_json(200, self.info)
+        elif path == "/health":
+            self._send_json(200, {"status": "ok", **self.batcher.stats()})
+        elif path == "/metrics":
+            body = self.batcher.metrics.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != "/detect":
+            self._send_json(404, {"error": "not found"})
+            return
+        query = dict(urllib.parse.parse_qsl(url.query))
+        started = time.perf_counter()
+        metrics = self.batcher.metrics
+        try:
+            shape = tuple(int(v) for v in query["shape"].split(","))
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            frame = np.frombuffer(body, dtype=np.uint8).reshape(shape)
+            params = parse_params(query)
+        except Exception as e:
+            self._send_json(400, {"error": f"bad request: {e}"})
+            return
+        try:
+            future = self.batcher.submit(frame, params)
+        except QueueFull:
+            self._send_json(503, {"error": "busy, retry"}, {"Retry-After": "1"})
+            return
+        try:
+            dets = future.result(timeout=self.timeout_s)
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, dets.to_dict())
+        metrics.inc("requests_total", source="server")
+        metrics.observe("request_seconds", time.perf_counter() - started, source="server")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(backend, host="127.0.0.1", port=8765, max_batch_size=16, max_wait_ms=10, max_queue=64):
+    handler = type("Handler", (InferenceHandler,), {
+        "batcher": MicroBatcher(backend, max_batch_size, max_wait_ms, max_queue),
+        "info": {"names": {str(k): v for k, v in backend.names.items()}, "weights_hash": backend.weights_hash},
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Traffic AI Vision inference service with micro-batching")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--weights", default="best.pt")
+    parser.add_argument("--backend", default="pytorch", choices=BACKENDS)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    parser.add_argument("--max-queue", type=int, default=64, help="Requests beyond this get 503 busy")
+    args = parser.parse_args()
+
+    backend = load_backend(args.weights, args.backend)
+    backend.warmup()
+    server = serve(backend, args.host, args.port, args.max_batch_size, args.max_wait_ms, args.max_queue)
+    print(f"Serving {args.weights} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+import csv
+import os
+import threading
+import time
+import weakref
+
+import cv2
+import numpy as np
+
+from detection import detection_rows, draw_detections
+from tracking import KeyframeDetector
+
+
+# -------------- Frame Sources ----------------
+class SyntheticSource:
+    # Stand-in for a camera: a dark street scene with a light cycling red/yellow/green
+    def __init__(self, width=640, height=480, fps=30):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.index = 0
+
+    def isOpened(self):
+        return True
+
+    def read(self):
+        frame = np.full((self.height, self.width, 3), 40, dtype=np.uint8)
+        colors = [(0, 0, 255), (0, 255, 255), (0, 255, 0)]
+        state = (self.index // max(int(self.fps), 1)) % len(colors)
+        x = int(self.width * 0.5 + self.width * 0.3 * np.sin(self.index / 50))
+        cv2.rectangle(frame, (x - 20, 60), (x + 20, 180), (30, 30, 30), -1)
+        cv2.circle(frame, (x, 80 + 40 * state), 15, colors[state], -1)
+        self.index += 1
+        return True, frame
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        return 0
+
+    def release(self):
+        pass
+
+
+class ImageFolderSource:
+    # A directory of still images played back in name order as if it were a camera
+    EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+    def __init__(self, path, fps=5):
+        self.paths = sorted(os.path.join(path, name) for name in os.listdir(path)
+                            if name.lower().endswith(self.EXTENSIONS))
+        self.fps = fps
+        self.index = 0
+
+    def isOpened(self):
+        return bool(self.paths)
+
+    def read(self):
+        while self.index < len(self.paths):
+            frame = cv2.imread(self.paths[self.index])
+            self.index += 1
+            if frame is not None:
+                return True, frame
+        return False, None
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return len(self.paths)
+        return 0
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self.index = int(value)
+
+    def release(self):
+        pass
+
+
+def open_source(source):
+    # "synthetic", a device index ("0"), a directory of images or a video file path / URL
+    if isinstance(source, str) and source.strip().lower() == "synthetic":
+        return SyntheticSource()
+    if isinstance(source, str) and os.path.isdir(source):
+        return ImageFolderSource(source)
+    if isinstance(source, str) and source.strip().isdigit():
+        source = int(source.strip())
+    return cv2.VideoCapture(source)
+
+
+# -------------- Background Grabber ----------------
+class FrameGrabber:
+    # Keeps one capture open and holds only the newest frame; stale frames are dropped
+    def __init__(self, source):
+        if isinstance(source, str) and source.strip().isdigit():
+            source = int(source.strip())
+        self.source = source
+        self.cap = None
+        self.frame = None
+        self.frame_id = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self.error = None
+        self._consumed_id = 0
+        self._lock = threading.Lock()
+        self._running = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.cap = open_source(self.source)
+        if not self.cap.isOpened():
+            self.cap.release()
+            raise RuntimeError(f"Could not open video source: {self.source}")
+        # Files and synthetic sources are paced at their native rate; devices block on read()
+        live_device = isinstance(self.cap, cv2.VideoCapture) and isinstance(self.source, int)
+        fps = self.cap.get(cv2.CAP_PROP_FPS) or 0
+        self._interval = 0 if live_device or fps <= 0 else 1.0 / fps
+        self._running.set()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        next_at = time.perf_counter()
+        while self._running.is_set():
+            ret, frame = self.cap.read()
+            if not ret:
+                if isinstance(self.source, str) and self.cap.get(cv2.CAP_PROP_FRAME_COUNT) > 0:
+                    # Loop video files so they behave like an endless stream
+                    self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    continue
+                if isinstance(self.source, str) and "://" in self.source:
+                    # Network cameras drop out and come back; one hiccup must not end the stream
+                    if self._reconnect():
+                        next_at = time.perf_counter()
+                        continue
+                    # Only stop() ends the retries, and a requested stop is not an error
+                    self.error = None
+                    break
+                self.error = "Frame read failed"
+                break
+            self.error = None
+            with self._lock:
+                if self.frame_id > self._consumed_id:
+                    self.dropped += 1
+                self.frame = frame
+                self.frame_id += 1
+            if self._interval:
+                next_at += self._interval
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_at = time.perf_counter()
+        self._running.clear()
+
+    def _reconnect(self, first_delay=0.5, max_delay=10.0):
+        # Reopens with exponential backoff until it works or stop() is called
+        delay = first_delay
+        while self._running.is_set():
+            self.error = f"Frame read failed, reconnecting in {delay:.1f}s"
+            self.cap.release()
+            if self._stop.wait(delay):
+                return False
+            try:
+                self.cap = open_source(self.source)
+            except Exception as e:
+                self.error = f"Reconnect failed: {e}"
+            else:
+                if self.cap.isOpened():
+                    self.reconnects += 1
+                    return True
+            delay = min(delay * 2, max_delay)
+        return False
+
+    def latest(self):
+        with self._lock:
+            self._consumed_id = self.frame_id
+            return self.frame_id, self.frame
+
+    @property
+    def running(self):
+        return self._running.is_set()
+
+    def stop(self):
+        self._running.clear()
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=2)
+        if self.cap is not None:
+            self.cap.release()
+
+
+class GrabberLease:
+    # Kept in exactly one owner (a Streamlit session's state). Nothing reports the end of a browser
+    # session, but its state is dropped, and with it the lease: the grabber then stops and releases the camera.
+    def __init__(self, grabber):
+        self.grabber = grabber
+        weakref.finalize(self, grabber.stop)
+
+
+# -------------- Video File Pipeline ----------------
+def iter_frames(path, stride=1):
+    # Generator so only the frames of the current batch are ever held in memory
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise RuntimeError(f"Could not open video: {path}")
+    try:
+        index = 0
+        while True:
+            if stride > 1 and index % stride:
+                # grab() skips the decode for frames we are not going to analyze
+                if not cap.grab():
+                    break
+            else:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                yield index, frame
+            index += 1
+    finally:
+        cap.release()
+
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def video_info(path):
+    cap = cv2.VideoCapture(path)
+    try:
+        return {
+            "fps": cap.get(cv2.CAP_PROP_FPS) or 30.0,
+            "frames": int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+            "width": int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            "height": int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        }
+    finally:
+        cap.release()
+
+
+def analyze_video(backend, path, video_out, log_out, stride=1, batch_size=8, keyframe_interval=1,
+                  detection_log=None, source=None, **params):
+    # Streams annotated frames to video_out and detections to log_out (CSV), and to detection_log
+    # (a DetectionLogWriter) stamped at analysis start plus the frame's offset into the video.
+    # With keyframe_interval > 1 only every Nth analyzed frame goes through the model and boxes are tracked in between.
+    # Yields (frames_done, frames_total, frames_per_sec, last_annotated_frame, invocation_rate) after each batch.
+    info = video_info(path)
+    total = (info["frames"] + stride - 1) // stride if info["frames"] > 0 else 0
+    writer = cv2.VideoWriter(
+        video_out,
+        cv2.VideoWriter_fourcc(*"mp4v"),
+        info["fps"] / stride,
+        (info["width"], info["height"]),
+    )
+    keyframes = KeyframeDetector(backend, keyframe_interval, **params) if keyframe_interval > 1 else None
+    done = 0
+    model_calls = 0
+    started = time.perf_counter()
+    wall_started = time.time()
+    try:
+        with open(log_out, "w", newline="") as log_file:
+            log = csv.writer(log_file)
+            log.writerow(["frame", "time_s", "class", "confidence", "x1", "y1", "x2", "y2"])
+            for batch in batched(iter_frames(path, stride), batch_size):
+                frames = [frame for _, frame in batch]
+                if keyframes is None:
+                    detections = backend.predict(frames, batch_size=len(frames), **params)
+                    model_calls += len(frames)
+                else:
+                    # Batch the keyframes of this chunk through the model, then track across the rest in order
+                    key_positions = [i for i in range(len(frames)) if (done + i) % keyframe_interval == 0]
+                    key_dets = {}
+                    if key_positions:
+                        key_frames = [frames[i] for i in key_positions]
+                        key_dets = dict(zip(key_positions, backend.predict(key_frames, batch_size=len(key_frames),
+                                                                           **params)))
+                    detections = [keyframes.process(frame, key_dets.get(i))[0] for i, frame in enumerate(frames)]
+                    model_calls += len(key_positions)
+                for (index, frame), dets in zip(batch, detections):
+                    annotated = draw_detections(frame, dets)
+                    writer.write(annotated)
+                    timestamp = round(index / info["fps"], 3)
+                    if detection_log is not None:
+                        detection_log.write(source or path, dets, wall_started + timestamp)
+                    for row in detection_rows(dets, index):
+                        log.writerow([index, timestamp, row["class"], row["confidence"],
+                                      row["x1"], row["y1"], row["x2"], row["y2"]])
+                done += len(batch)
+                yield done, total, done / (time.perf_counter() - started), annotated, model_calls / done
+    finally:
+        writer.release()
@@ -0,0 +1,268 @@
+from collections import deque
+
+import cv2
+import numpy as np
+
+from detection import Detections
+
+
+# -------------- Box Matching ----------------
+def iou_matrix(a, b):
+    # (len(a), len(b)) IoU for xyxy boxes, fully vectorized
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros((len(a), len(b)), dtype=np.float32)
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return inter / (area_a[:, None] + area_b[None, :] - inter + 1e-9)
+
+
+def greedy_match(ious, threshold):
+    pairs = []
+    if ious.size == 0:
+        return pairs
+    rows, cols = np.unravel_index(np.argsort(-ious, axis=None), ious.shape)
+    used_rows, used_cols = set(), set()
+    for r, c in zip(rows, cols):
+        if ious[r, c] < threshold:
+            break
+        if r in used_rows or c in used_cols:
+            continue
+        pairs.append((int(r), int(c)))
+        used_rows.add(r)
+        used_cols.add(c)
+    return pairs
+
+
+# -------------- Tracker ----------------
+class Track:
+    def __init__(self, track_id, box, cls, conf, history):
+        self.id = track_id
+        self.box = np.asarray(box, dtype=np.float32)
+        self.anchor = self.box.copy()
+        self.velocity = np.zeros(4, dtype=np.float32)
+        self.conf = float(conf)
+        self.age = 0
+        self.history = deque([(int(cls), float(conf))], maxlen=history)
+
+    def smoothed_class(self, num_classes):
+        # Confidence-weighted vote over recent keyframes, so a single flickery
+        # red/yellow/green misclassification does not flip the reported state
+        classes = np.array([c for c, _ in self.history])
+        weights = np.array([p for _, p in self.history])
+        return int(np.bincount(classes, weights=weights, minlength=num_classes).argmax())
+
+
+class IoUTracker:
+    # Matches keyframe detections to tracks by IoU and moves boxes between keyframes with sparse optical flow
+    def __init__(self, names, iou_threshold=0.3, max_age=30, history=7, flow_size=640):
+        self.names = names
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.history = history
+        self.flow_size = flow_size
+        self.tracks = []
+        self.next_id = 1
+        self.last_changes = 0
+        self._prev_gray = None
+        self._shape = None
+
+    def _gray(self, frame):
+        scale = min(1.0, self.flow_size / max(frame.shape[:2]))
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if scale < 1.0:
+            gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return gray, scale
+
+    def update(self, dets, frame):
+        # Keyframe: fresh detections replace propagated boxes
+        self._shape = frame.shape[:2]
+        boxes = np.array([t.box for t in self.tracks], dtype=np.float32).reshape(-1, 4)
+        pairs = greedy_match(iou_matrix(boxes, dets.xyxy), self.iou_threshold)
+        matched_tracks = {r for r, _ in pairs}
+        matched_dets = {c for _, c in pairs}
+        changes = 0
+        for r, c in pairs:
+            track = self.tracks[r]
+            # Velocity from the last keyframe match, used when optical flow loses the box
+            box = dets.xyxy[c].astype(np.float32)
+            track.velocity = (box - track.anchor) / max(track.age, 1)
+            previous = track.smoothed_class(len(self.names))
+            track.box, track.anchor = box, box.copy()
+            track.conf = float(dets.conf[c])
+            track.history.append((int(dets.cls[c]), float(dets.conf[c])))
+            track.age = 0
+            changes += track.smoothed_class(len(self.names)) != previous
+        kept = []
+        for i, track in enumerate(self.tracks):
+            if i in matched_tracks or track.age < self.max_age:
+                kept.append(track)
+            else:
+                changes += 1
+        for c in range(len(dets)):
+            if c not in matched_dets:
+                kept.append(Track(self.next_id, dets.xyxy[c], dets.cls[c], dets.conf[c], self.history))
+                self.next_id += 1
+                changes += 1
+        # Tracks the detector missed this keyframe age out instead of vanishing immediately
+        for i, track in enumerate(self.tracks):
+            if i not in matched_tracks:
+                track.age += 1
+        self.tracks = kept
+        self.last_changes = changes
+        self._prev_gray = self._gray(frame)
+        return self.output()
+
+    def propagate(self, frame):
+        # Between keyframes: shift each box by the median flow of a 3x3 point grid inside it
+        self._shape = frame.shape[:2]
+        gray, scale = self._gray(frame)
+        if self.tracks and self._prev_gray is not None and self._prev_gray[0].shape == gray.shape:
+            grid = np.linspace(0.25, 0.75, 3, dtype=np.float32)
+            gx, gy = np.meshgrid(grid, grid)
+            offsets = np.stack([gx.ravel(), gy.ravel()], axis=1)
+            boxes = np.array([t.box for t in self.tracks], dtype=np.float32)
+            sizes = boxes[:, 2:] - boxes[:, :2]
+            points = (boxes[:, None, :2] + offsets[None] * sizes[:, None]) * scale
+            prev_points = points.reshape(-1, 1, 2).astype(np.float32)
+            next_points, status, _ = cv2.calcOpticalFlowPyrLK(self._prev_gray[0], gray, prev_points, None,
+                                                              winSize=(15, 15), maxLevel=2)
+            flow = ((next_points - prev_points).reshape(len(boxes), -1, 2)) / scale
+            ok = status.reshape(len(boxes), -1).astype(bool)
+            for track, track_flow, track_ok in zip(self.tracks, flow, ok):
+                if track_ok.sum() >= 3:
+                    dx, dy = np.median(track_flow[track_ok], axis=0)
+                    track.box += np.array([dx, dy, dx, dy], dtype=np.float32)
+                else:
+                    track.box += track.velocity
+        else:
+            for track in self.tracks:
+                track.box += track.velocity
+        for track in self.tracks:
+            track.age += 1
+        self.tracks = [t for t in self.tracks if t.age <= self.max_age]
+        self._prev_gray = (gray, scale)
+        return self.output()
+
+    def output(self):
+        shape = self._shape or (0, 0)
+        if not self.tracks:
+            return Detections(np.zeros((0, 4)), [], [], self.names, shape, ids=[])
+        boxes = np.array([t.box for t in self.tracks], dtype=np.float32)
+        boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, shape[1])
+        boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, shape[0])
+        return Detections(
+            boxes,
+            [t.conf for t in self.tracks],
+            [t.smoothed_class(len(self.names)) for t in self.tracks],
+            self.names,
+            shape,
+            ids=[t.id for t in self.tracks],
+        )
+
+
+# -------------- Keyframe Scheduling ----------------
+class KeyframeDetector:
+    # Runs the model every `every_n` frames (or adaptively) and tracks in between
+    def __init__(self, backend, every_n=5, adaptive=False, max_every=30, **params):
+        self.backend = backend
+        self.params = params
+        self.interval = max(1, every_n)
+        self.adaptive = adaptive
+        self.max_every = max_every
+        self.tracker = IoUTracker(backend.names)
+        self.frames = 0
+        self.model_calls = 0
+        self._since_keyframe = None
+
+    def is_keyframe(self):
+        return self._since_keyframe is None or self._since_keyframe >= self.interval
+
+    def process(self, frame, dets=None):
+        # dets may be passed in when the caller already batched the keyframe inference
+        self.frames += 1
+        if dets is not None or self.is_keyframe():
+            if dets is None:
+                dets = self.backend.predict([frame], **self.params)[0]
+            self.model_calls += 1
+            self._since_keyframe = 1
+            out = self.tracker.update(dets, frame)
+            if self.adaptive:
+                # Scene changed (tracks appeared, vanished or switched state): look more often
+                if self.tracker.last_changes:
+                    self.interval = max(1, self.interval // 2)
+                else:
+                    self.interval = min(self.max_every, self.interval + 1)
+            return out, True
+        self._since_keyframe += 1
+        return self.tracker.propagate(frame), False
+
+    @property
+    def invocation_rate(self):
+        return self.model_calls / self.frames if self.frames else 0.0
+
+
+# -------------- Motion Gating ----------------
+MOTION_METHODS = ["diff", "hash"]
+
+
+class MotionGate:
+    # Skips the model on fixed cameras while the scene matches the last analyzed frame.
+    # "diff" is the mean absolute difference of a small grayscale thumbnail, "hash" the share
+    # of differing bits in a 64-bit difference hash; both are scored 0..1 against threshold.
+    def __init__(self, threshold=0.02, method="diff", size=64):
+        if method not in MOTION_METHODS:
+            raise ValueError(f"Unknown motion method {method!r}, expected one of {MOTION_METHODS}")
+        self.threshold = threshold
+        self.method = method
+        self.size = size
+        self.checks = 0
+        self.skips = 0
+        self.last_score = None
+        self.result = None
+        self._reference = None
+        self._key = None
+
+    def signature(self, frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        if self.method == "hash":
+            small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+            return small[:, 1:] > small[:, :-1]
+        small = cv2.resize(gray, (self.size, self.size), interpolation=cv2.INTER_AREA)
+        return small.astype(np.int16)
+
+    def score(self, signature):
+        if self.method == "hash":
+            return float(np.count_nonzero(signature != self._reference)) / signature.size
+        return float(np.abs(signature - self._reference).mean()) / 255.0
+
+    def gated(self, frame, run, key=None):
+        # Returns (result, skipped); run() is only called when the scene changed or key (the inference settings) did
+        self.checks += 1
+        signature = self.signature(frame)
+        if self._reference is not None and key == self._key:
+            self.last_score = self.score(signature)
+            if self.last_score < self.threshold:
+                self.skips += 1
+                return self.result, True
+        else:
+            self.last_score = None
+        self.result = run()
+        self._reference = signature
+        self._key = key
+        return self.result, False
+
+    def reset(self):
+        self.result = None
+        self._reference = None
+        self._key = None
+
+    def stats(self):
+        return {
+            "checks": self.checks,
+            "skips": self.skips,
+            "model_calls": self.checks - self.skips,
+            "skip_rate": self.skips / self.checks if self.checks else 0.0,
+        }